@@ -5,113 +5,756 @@ Created on Mon May  7 14:58:05 2018
 @author: mlgkschm
 """
 
+import os
 import csv
-from math import sqrt
+import copy
+import json
+import hashlib
+import queue
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from math import sqrt, nextafter, ceil
 from warnings import warn
+import numpy as np
+from simpy.core import StopSimulation
 
 # Q: How do you guarrantee the state names are not misspelled?
 # A: Use this dict to check harvester state names for validity
 st = {'off': 'off', 'cold': 'cold', 'warm': 'warm', 'full': 'full'}
+# integer codes for the harvester states, as the state log keeps them
+codes = {st['off']: 0, st['cold']: 1, st['warm']: 2, st['full']: 3}
+names = [st['off'], st['cold'], st['warm'], st['full']]
 
 ##############################################################################
 # A master clock object
+# 'tick' and 'tock' are plain timeouts.  The clock's own callback is the
+# first on each, and it schedules the next one before the waiting processes
+# resume, so they find the new marker when they yield on it again
+# 'resume' is a state from 'getState', to carry on a checkpointed run
+# 'verbose' False drops the start/stop messages
 class clock:
-    def __init__(self,env,period):
+    saved = ('tTick', 'tTock', 'started')
+    
+    def __init__(self,env,period,resume=None,verbose=True):
         self.env = env
+        self.verbose = verbose
         self.period = period  # Primary clock period
         self.Tpost = period/10  # Secondary clock delay from primary
         self.tick = None  # Primary time marker, for computing
         self.tock = None  # Secondary time marker, for post processing
         self.req = {}  # list of devices relying on 'clock'
         self.running = True
-        self.env.process(self.runTick(self.period))  # start Primary
-        self.env.process(self.runTock(self.period))  # start Secondary
-    
-    def runTick(self,period):
-        print('Clock start: @ %f' % self.env.now)
-        #
-        while len(self.req) == 0:
-            self.tick = self.env.process(self.step(period))
-            yield self.tick
-        #
-        while len(self.req) > 0:
-            self.tick = self.env.process(self.step(period))
-            yield self.tick
-        #
-        print('Clock stop: @ %f' % self.env.now)
-        self.running = False
-        self.tick = None
-    
-    def runTock(self,period):
-        self.tock = self.env.timeout(self.Tpost)  # delay from T=0
-        yield self.tock
-        #
-        while self.running:  # then start secondary clock
-            self.tock = self.env.process(self.step(period))
-            yield self.tock
-        #
-        print('Tock stop: @ %f' % self.env.now)
-        self.tock = None
-    
-    def step(self,delT):
-        yield self.env.timeout(delT)
+        self.started = False  # a device has asked for the clock
+        self.tTick = self.env.now + self.period  # times of the next markers
+        self.tTock = self.env.now + self.Tpost  # delayed from T=0
+        if defined(resume):
+            setState(self, resume)
+        self.tick = self.env.timeout(timeTo(self.env, self.tTick))
+        self.tick.callbacks.append(self.nextTick)  # start Primary
+        self.tock = self.env.timeout(timeTo(self.env, self.tTock))
+        self.tock.callbacks.append(self.nextTock)  # start Secondary
+        self.env.process(self.runStart())
+    
+    def runStart(self):
+        if self.verbose:
+            print('Clock start: @ %f' % self.env.now)
+        yield self.tick
+    
+    def nextTick(self,event):
+        # runs until the last device stops, or forever if none ever starts
+        self.started = self.started or len(self.req) > 0
+        if len(self.req) > 0 or not self.started:
+            self.tTick = self.env.now + self.period
+            self.tick = self.env.timeout(self.period)
+            self.tick.callbacks.append(self.nextTick)
+        else:
+            if self.verbose:
+                print('Clock stop: @ %f' % self.env.now)
+            self.running = False
+            self.tick = None
+    
+    def nextTock(self,event):
+        if self.running:
+            self.tTock = self.env.now + self.period
+            self.tock = self.env.timeout(self.period)
+            self.tock.callbacks.append(self.nextTock)
+        else:
+            if self.verbose:
+                print('Tock stop: @ %f' % self.env.now)
+            self.tock = None
     
     def start(self,req):
-        print('Req clock start: %s @ %f' % (req.name,self.env.now))
+        if self.verbose:
+            print('Req clock start: %s @ %f' % (req.name,self.env.now))
         self.req[req] = req.name
     
     def stop(self,req):
-        print('Req clock stop: %s @ %f' % (req.name,self.env.now))
+        if self.verbose:
+            print('Req clock stop: %s @ %f' % (req.name,self.env.now))
         del self.req[req]
 
 ##############################################################################
 # An object to collect data on any node
+# Samples are staged in a short list and moved to NumPy arrays that grow by
+# 'block' rows, so 'time' and 'data' are arrays, not lists
+#   every:    keep every n-th tock
+#   envelope: also keep the min and max of each 'every' tocks in 'lo', 'hi'
+#   window:   keep only the last 'window' seconds, in a ring buffer
 class scope:
-    def __init__(self,env,clock,node,unit=1):
+    def __init__(self,env,clock,node,unit=1,every=1,envelope=False,
+                 window=None,block=4096):
         self.env = env
         self.unit = unit
         self.name = 'Scope'+str(self.unit)
         self.clock = clock
         self.node_obj = node[0]
         self.node_atr = node[1]
-        self.time = []
-        self.data = []
+        self.every = every
+        self.envelope = envelope
+        self.block = block
+        self.cols = 4 if envelope else 2  # time, data[, lo, hi]
+        self.size = None  # ring buffer rows, for 'window'
+        if defined(window):
+            self.size = int(ceil(window / (clock.period * every))) + 1
+        self._arr = np.empty((self.cols, self.size or block))
+        self._n = 0  # rows held in '_arr'
+        self._head = 0  # ring buffer: row of the oldest sample
+        self._buf = [[] for i in range(self.cols)]  # staged columns
+        self._count = 0  # samples seen
+        self._bucket = None  # envelope: [time, data, lo, hi] being filled
         self.env.process(self.run())
     
     def run(self):
         #self.clock.start(self)
         collect = True
+        plain = self.every == 1 and not self.envelope
+        bt, bd = self._buf[0], self._buf[1]
         while collect and self.clock.running:
             yield self.clock.tock
 #            data = self.node()
             data = getattr(self.node_obj,self.node_atr)
             collect = defined(data)
-            if collect:
-                self.time.append(self.env.now)
-                self.data.append(data)
+            if not collect:
+                pass
+            elif plain:  # the common case, inline
+                bt.append(self.env.now)
+                bd.append(data)
+                if len(bt) >= self.block:
+                    self._flush()
+            else:
+                self.sample(self.env.now,data)
         #self.clock.stop(self)
+        self._close()
+    
+    def sample(self,time,data):
+        first = self._count % self.every == 0
+        self._count += 1
+        if self.envelope:
+            if first:
+                self._close()
+                self._bucket = [time, data, data, data]
+            else:
+                b = self._bucket
+                if data < b[2]: b[2] = data
+                if data > b[3]: b[3] = data
+        elif first:
+            self._stage((time, data))
+    
+    def _close(self):
+        # finish the envelope bucket being filled
+        if defined(self._bucket):
+            self._stage(self._bucket)
+            self._bucket = None
+    
+    def _stage(self,row):
+        for col, value in zip(self._buf, row):
+            col.append(value)
+        if len(self._buf[0]) >= self.block:
+            self._flush()
+    
+    def _flush(self):
+        # move the staged rows into the arrays
+        k = len(self._buf[0])
+        if not k:
+            return
+        rows = np.empty((self.cols, k))
+        for i, col in enumerate(self._buf):
+            rows[i] = col
+            del col[:]  # keep the lists, 'run' holds them
+        if defined(self.size):  # ring buffer, overwrite the oldest rows
+            if k >= self.size:
+                rows, k = rows[:, -self.size:], self.size
+                self._head, self._n = 0, 0
+            end = self._head + self._n
+            i = np.arange(end, end + k) % self.size
+            self._arr[:, i] = rows
+            drop = max(0, self._n + k - self.size)
+            self._head = (self._head + drop) % self.size
+            self._n = min(self.size, self._n + k)
+            return
+        if self._n + k > self._arr.shape[1]:  # grow by whole blocks
+            grow = max(self.block, self._arr.shape[1], k)
+            arr = np.empty((self.cols, self._arr.shape[1] + grow))
+            arr[:, :self._n] = self._arr[:, :self._n]
+            self._arr = arr
+        self._arr[:, self._n:self._n + k] = rows
+        self._n += k
+    
+    def _column(self,col):
+        self._flush()
+        if defined(self.size) and self._head:
+            arr = np.roll(self._arr[col, :self._n], -self._head)
+        else:
+            arr = self._arr[col, :self._n]
+        if defined(self._bucket):  # include the bucket being filled
+            arr = np.append(arr, self._bucket[col])
+        return(arr)
+    
+    def __len__(self):
+        return(len(self._column(0)))
+    
+    @property
+    def time(self):
+        return(self._column(0))
+    
+    @property
+    def data(self):
+        return(self._column(1))
+    
+    @property
+    def lo(self):
+        return(self._column(2) if self.envelope else None)
+    
+    @property
+    def hi(self):
+        return(self._column(3) if self.envelope else None)
+    
+    @property
+    def trace(self):
+        return(Trace(self.time, self.data, self.name))
+
+##############################################################################
+# Many scopes in one: a single process samples every node on each tock into
+# a columnar table, one row per tock.  'add' returns a 'probe', a view with
+# the 'time' and 'data' of one node, as a 'scope' has
+# With 'spill' set to a folder, full blocks are handed to a writer thread
+# that appends them to one raw float64 file per column, and the columns are
+# read back as memory-maps; see 'ProbeFile'
+class ProbeSet:
+    def __init__(self,env,clock,nodes={},every=1,block=4096,spill=None):
+        self.env = env
+        self.clock = clock
+        self.every = every
+        self.block = block
+        self.names = []
+        self.probes = {}
+        self._get = []  # one getter per node, resolved in 'add'
+        self._end = []  # row count at which each node returned None
+        self._arr = np.empty((1, block))  # time, then one row per node
+        self._n = 0
+        self._buf = []  # staged samples, flat
+        self._proc = None
+        self.spill = spill
+        self._writer = None
+        for name, node in nodes.items():
+            self.add(name, node)
+    
+    def add(self,name,node):
+        if self._n or self._buf:
+            raise RuntimeError('ProbeSet: add nodes before the run')
+        obj, atr = node
+        prop = getattr(type(obj), atr, None)
+        if isinstance(prop, property):  # call the getter directly
+            get = prop.fget.__get__(obj)
+        elif atr in getattr(obj, '__dict__', {}):
+            get = lambda d=obj.__dict__, a=atr: d[a]
+        else:
+            get = lambda o=obj, a=atr: getattr(o, a)
+        self.names.append(name)
+        self._get.append(get)
+        self._end.append(None)
+        self._arr = np.empty((len(self.names) + 1, self.block))
+        self.probes[name] = probe(self, len(self.names))
+        if not defined(self._proc):
+            self._proc = self.env.process(self.run())
+        return(self.probes[name])
+    
+    def __getitem__(self,name):
+        return(self.probes[name])
+    
+    def run(self):
+        buf = self._buf
+        get = self._get
+        every = self.every
+        count = 0
+        while self.clock.running:
+            yield self.clock.tock
+            count += 1
+            if (count - 1) % every:
+                continue
+            row = [g() for g in get]
+            if None in row:  # a node ran out, stop its column there
+                rows = self._n + len(buf) // (len(get) + 1)
+                for i, value in enumerate(row):
+                    if value is None:
+                        if self._end[i] is None:
+                            self._end[i] = rows
+                        row[i] = np.nan
+                if None not in self._end:
+                    break
+            buf.append(self.env.now)
+            buf.extend(row)
+            if len(buf) >= self.block * (len(get) + 1):
+                self._flush()
+    
+    def _flush(self):
+        # move the staged rows into the table
+        cols = len(self._get) + 1
+        k = len(self._buf) // cols
+        if not k:
+            return
+        rows = np.array(self._buf, dtype=float).reshape(k, cols).T
+        del self._buf[:]  # keep the list, 'run' holds it
+        if defined(self.spill):
+            if not defined(self._writer):
+                self._writer = spillWriter(self.spill, cols)
+            self._writer.put(rows)
+            self._n += k
+            return
+        if self._n + k > self._arr.shape[1]:  # grow by whole blocks
+            grow = max(self.block, self._arr.shape[1], k)
+            arr = np.empty((cols, self._arr.shape[1] + grow))
+            arr[:, :self._n] = self._arr[:, :self._n]
+            self._arr = arr
+        self._arr[:, self._n:self._n + k] = rows
+        self._n += k
+    
+    def column(self,col):
+        # a view of one column, up to the row where its node ran out
+        self._flush()
+        end = self._end[col - 1] if col else None
+        n = self._n if end is None else end
+        if defined(self.spill):
+            self.sync()
+            return(self._writer.column(col)[:n] if defined(self._writer)
+                   else np.empty(0))
+        return(self._arr[col, :n])
+    
+    @property
+    def time(self):
+        return(self.column(0))
+    
+    def sync(self):
+        # wait for the writer thread, then update the index of the folder
+        self._flush()
+        if defined(self._writer):
+            self._writer.sync()
+            self._writer.index(self.names, self._end, self._n)
+    
+    def close(self):
+        self.sync()
+        if defined(self._writer):
+            self._writer.close()
+
+# The writer thread of a spilling 'ProbeSet'
+class spillWriter:
+    def __init__(self,folder,cols):
+        self.folder = folder
+        self.cols = cols
+        os.makedirs(folder, exist_ok=True)
+        self.files = [os.path.join(folder, 'col%03d.f8' % i)
+                      for i in range(cols)]
+        self._out = [open(f, 'wb') for f in self.files]
+        self._queue = queue.Queue()  # unbounded, 'put' never waits
+        self._error = None
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+    
+    def put(self,rows):
+        if defined(self._error):
+            raise self._error
+        self._queue.put(rows)
+    
+    def run(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    for f in self._out:
+                        f.close()
+                    return
+                for f, col in zip(self._out, rows):
+                    f.write(np.ascontiguousarray(col).tobytes())
+                for f in self._out:
+                    f.flush()
+            except Exception as e:  # raised again in the simulation thread
+                self._error = e
+            finally:
+                self._queue.task_done()
+    
+    def sync(self):
+        self._queue.join()
+        if defined(self._error):
+            raise self._error
+    
+    def index(self,names,end,rows):
+        with open(os.path.join(self.folder, 'index.json'), 'w') as f:
+            json.dump({'names': names, 'end': end, 'rows': rows}, f)
+    
+    def column(self,col):
+        return(readColumn(self.files[col]))
+    
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+def readColumn(fname):
+    # a raw float64 column file, memory-mapped
+    if os.path.getsize(fname) == 0:
+        return(np.empty(0))
+    return(np.memmap(fname, dtype=float, mode='r'))
+
+# The probes of a spilled 'ProbeSet', read back lazily from its folder
+class ProbeFile:
+    def __init__(self,folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'index.json')) as f:
+            index = json.load(f)
+        self.names = index['names']
+        self._end = index['end']
+        self._n = index['rows']
+        self.probes = {name: probe(self, i + 1)
+                       for i, name in enumerate(self.names)}
+    
+    def __getitem__(self,name):
+        return(self.probes[name])
+    
+    def column(self,col):
+        end = self._end[col - 1] if col else None
+        n = self._n if end is None else end
+        fname = os.path.join(self.folder, 'col%03d.f8' % col)
+        return(readColumn(fname)[:n])
+    
+    @property
+    def time(self):
+        return(self.column(0))
+
+# One node of a 'ProbeSet'
+class probe:
+    def __init__(self,probes,col):
+        self.probes = probes
+        self.col = col
+        self.name = probes.names[col - 1]
+    
+    def __len__(self):
+        return(len(self.data))
+    
+    @property
+    def time(self):
+        return(self.probes.column(0)[:len(self.data)])
+    
+    @property
+    def data(self):
+        return(self.probes.column(self.col))
+    
+    @property
+    def trace(self):
+        return(Trace(self.time, self.data, self.name))
+
+##############################################################################
+# A sampled signal: NumPy 'time' and 'data' arrays, for the analysis of
+# probe records.  Arithmetic between two Traces with different timestamps
+# is done at the left operand's times, the right one interpolated there,
+# NaN outside its span.  Every method returns a new Trace or an array
+class Trace:
+    def __init__(self,time,data,name=None):
+        self.time = np.asarray(time, dtype=float)
+        self.data = np.asarray(data, dtype=float)
+        self.name = name
+    
+    def __len__(self):
+        return(len(self.data))
+    
+    def __array__(self,dtype=None,copy=None):
+        return(self.data if dtype is None else self.data.astype(dtype))
+    
+    def __repr__(self):
+        return('Trace(%s, %d samples, %g..%g s)' % (self.name, len(self),
+               self.time[0] if len(self) else 0,
+               self.time[-1] if len(self) else 0))
+    
+    def at(self,times):
+        # values at 'times', interpolated, NaN outside the record
+        if not len(self):
+            return(np.full(np.shape(times), np.nan))
+        return(np.interp(times, self.time, self.data, left=np.nan,
+                         right=np.nan))
+    
+    def _other(self,other):
+        # the data of 'other' at this trace's times
+        if not isinstance(other, Trace):
+            return(other)
+        if other.time is self.time or (len(other) == len(self) and
+                                       np.array_equal(other.time, self.time)):
+            return(other.data)
+        return(other.at(self.time))
+    
+    def _op(self,f,other,name):
+        return(Trace(self.time, f(self.data, self._other(other)), name))
+    
+    def __add__(self,other):
+        return(self._op(np.add, other, self.name))
+    
+    def __sub__(self,other):
+        return(self._op(np.subtract, other, self.name))
+    
+    def __mul__(self,other):
+        return(self._op(np.multiply, other, self.name))
+    
+    def __truediv__(self,other):
+        return(self._op(np.divide, other, self.name))
+    
+    def __pow__(self,other):
+        return(self._op(np.power, other, self.name))
+    
+    def __radd__(self,other):
+        return(self._op(lambda a, b: b + a, other, self.name))
+    
+    def __rsub__(self,other):
+        return(self._op(lambda a, b: b - a, other, self.name))
+    
+    def __rmul__(self,other):
+        return(self._op(lambda a, b: b * a, other, self.name))
+    
+    def __rtruediv__(self,other):
+        return(self._op(lambda a, b: b / a, other, self.name))
+    
+    def __neg__(self):
+        return(Trace(self.time, -self.data, self.name))
+    
+    def __abs__(self):
+        return(Trace(self.time, np.abs(self.data), self.name))
+    
+    def apply(self,f,name=None):
+        # f(data), e.g. np.sqrt
+        return(Trace(self.time, f(self.data), name or self.name))
+    
+    ##########################################################################
+    # time alignment
+    
+    def resample(self,times):
+        # at other times: an array, a Trace's times, or a period in seconds
+        if isinstance(times, Trace):
+            times = times.time
+        elif np.ndim(times) == 0:
+            n = int(np.floor((self.time[-1] - self.time[0]) / times + 1e-9))
+            times = self.time[0] + times * np.arange(n + 1)
+        return(Trace(times, self.at(times), self.name))
+    
+    def align(self,*others):
+        # this trace and 'others' at common times: this trace's, within
+        # the span that all of them cover
+        t0 = max([self.time[0]] + [o.time[0] for o in others])
+        t1 = min([self.time[-1]] + [o.time[-1] for o in others])
+        base = self.between(t0, t1)
+        return([base] + [o.resample(base.time) for o in others])
+    
+    def between(self,t0=None,t1=None):
+        # the samples with t0 <= time <= t1
+        i = 0 if t0 is None else np.searchsorted(self.time, t0, side='left')
+        j = len(self) if t1 is None else np.searchsorted(self.time, t1,
+                                                         side='right')
+        return(Trace(self.time[i:j], self.data[i:j], self.name))
+    
+    ##########################################################################
+    # integrals and reductions
+    
+    def integral(self,name=None):
+        # the cumulative integral over time, by trapezoids; e.g. P -> U
+        dI = (self.data[1:] + self.data[:-1]) / 2 * np.diff(self.time)
+        return(Trace(self.time, np.concatenate(([0.0], np.cumsum(dI))),
+                     name or self.name))
+    
+    def total(self):
+        # the integral over the whole record
+        return(float(np.sum((self.data[1:] + self.data[:-1]) / 2 *
+                            np.diff(self.time))))
+    
+    def mean(self):
+        # the time-weighted mean
+        span = self.time[-1] - self.time[0] if len(self) > 1 else 0
+        return(self.total() / span if span else float(np.mean(self.data)))
+    
+    def diff(self,name=None):
+        # the rate of change, between samples, at the later sample's time
+        return(Trace(self.time[1:], np.diff(self.data) / np.diff(self.time),
+                     name or self.name))
+    
+    def window(self,width,how='mean'):
+        # one value per 'width' seconds of samples, at the window's start:
+        # 'mean', 'sum', 'min', 'max' or 'std' of the samples in it
+        k = np.floor((self.time - self.time[0]) / width + 1e-9).astype(int)
+        start = np.flatnonzero(np.diff(k, prepend=-1))
+        n = np.diff(np.append(start, len(self)))
+        if how == 'min':
+            out = np.minimum.reduceat(self.data, start)
+        elif how == 'max':
+            out = np.maximum.reduceat(self.data, start)
+        else:
+            s = np.add.reduceat(self.data, start)
+            out = s if how == 'sum' else s / n
+            if how == 'std':
+                s2 = np.add.reduceat(self.data**2, start) / n
+                out = np.sqrt(np.maximum(s2 - out**2, 0))
+        t = self.time[0] + k[start] * width
+        return(Trace(t, out, self.name))
+
+##############################################################################
+# Stop the run early once a condition holds, checked on every n-th tock
+# Conditions are callables returning True to stop, e.g. from 'whenExhausted',
+# 'whenCrossed', 'whenSteady' or 'whenAll'.  'env.run' returns at the first
+# one that holds and 'reason' names it; 'done' is the event that stops it.
+# When the clock stops, nothing changes any more: the conditions are checked
+# a last time and the run stops there, for reason 'clock' if none holds
+class stopper:
+    def __init__(self,env,clock,conds={},every=1):
+        self.env = env
+        self.clock = clock
+        self.every = every
+        self.conds = dict(conds)
+        self.reason = None
+        self.time = None  # when it stopped
+        self.done = env.event()
+        self.done.callbacks.append(StopSimulation.callback)
+        self.env.process(self.run())
+    
+    def add(self,name,cond):
+        self.conds[name] = cond
+    
+    def run(self):
+        count = 0
+        while self.clock.running:
+            yield self.clock.tock
+            count += 1
+            if count % self.every:
+                continue
+            if self.check():
+                return
+        if not self.check():
+            self.stop('clock')
+    
+    def check(self):
+        for name, cond in self.conds.items():
+            if cond():
+                self.stop(name)
+                return(True)
+        return(False)
+    
+    def stop(self,reason):
+        self.reason = reason
+        self.time = self.env.now
+        self.done.succeed(reason)
+
+# An input source has run out of data
+def whenExhausted(src):
+    return(lambda: src.exhausted)
+
+# A node has been on one side of 'value' for 'hold' seconds, op: '<' or '>'
+# With 'arm', only once it has been on the other side, e.g. for a node that
+# starts below 'value' and must first rise past it
+def whenCrossed(env,node,op,value,hold=0,arm=False):
+    obj, atr = node
+    since = [None]
+    armed = [not arm]
+    def cond():
+        V = getattr(obj, atr)
+        if not defined(V) or not (V < value if op == '<' else V > value):
+            since[0] = None
+            armed[0] = armed[0] or defined(V)
+            return(False)
+        if not armed[0]:
+            return(False)
+        if since[0] is None:
+            since[0] = env.now
+        return(env.now - since[0] >= hold)
+    return(cond)
+
+# Every condition holds at once
+def whenAll(*conds):
+    return(lambda: all(c() for c in conds))
+
+# A node repeats itself with period 'period' seconds, to within 'tol'
+# It is sampled each time the condition is checked; the last two periods
+# are compared once per period, so most checks only store a sample
+class whenSteady:
+    def __init__(self,clock,node,period,tol,every=1,after=0):
+        self.obj, self.atr = node
+        self.n = max(1, int(round(period / (clock.period * every))))
+        self.tol = tol
+        self.after = after  # ignore the start of the run
+        self.clock = clock
+        self._buf = np.full(2 * self.n, np.nan)
+        self._count = 0
+    
+    def __call__(self):
+        if self.clock.env.now < self.after:
+            return(False)
+        V = getattr(self.obj, self.atr)
+        self._buf[self._count % (2 * self.n)] = np.nan if V is None else V
+        self._count += 1
+        if self._count < 2 * self.n or self._count % self.n:
+            return(False)
+        # ring holds the last two periods, oldest first after a roll
+        buf = np.roll(self._buf, -(self._count % (2 * self.n)))
+        return(bool(np.max(np.abs(buf[self.n:] - buf[:self.n])) <= self.tol))
 
 ##############################################################################
 # A class to switch something, 'obj', on and off, using method 'obj.en'
 class OnOff:
-    def __init__(self,env,clk,doList,obj):
+    saved = ('i', 'tNext')
+    
+    def __init__(self,env,clk,doList,obj,start=True):
         self.env = env
         self.clk = clk
         # doList is a list of sleep times in seconds, not cumulative
         self.doList = doList
         self.obj = obj
-        self.env.process(self.run())
-    
-    def run(self):
-        for sleep in self.doList:
-            yield self.env.timeout(sleep)
+        self.i = 0  # doList entry being slept
+        self.tNext = None  # time it ends
+        if start:
+            self.env.process(self.run())
+    
+    def run(self,resume=False):
+        for self.i in range(self.i, len(self.doList)):
+            if not resume:
+                self.tNext = self.env.now + self.doList[self.i]
+            resume = False
+            yield self.env.timeout(timeTo(self.env, self.tNext))
             if not self.clk.running: break
             self.obj.en = not self.obj.en
+        self.i = len(self.doList)
+    
+    def resume(self):
+        # carry on from a state set by 'setState'
+        if self.i < len(self.doList):
+            self.env.process(self.run(resume=True))
 
 ##############################################################################
 # Create an object to manage file-based power models
+# The trace is held in two float arrays, 'time' and 'data'; P at env.now is
+# interpolated from a cursor that follows env.now, with a binary search
+# when time jumps.  'sample' interpolates many times at once.
+# With a 'grid' clock, P and its integral are computed ahead for 'block'
+# ticks and tocks at a time in one pass, and read from that table.  'Utot'
+# is the energy of the source since '_t0', the integral of the trace, so it
+# does not depend on how often P is read
 class Psrc:
-    def __init__(self,env,I=None,V=None,R=None,unit=1,fname="src_data.csv",Tscale=1,Pscale=1,en=True):
+    saved = ('_t0', '_en')  # the cursor is found again by '_seek'
+    
+    def __init__(self,env,I=None,V=None,R=None,unit=1,fname="src_data.csv",Tscale=1,Pscale=1,en=True,trace=None,cache=False,grid=None,block=4096):
         self.env = env
         self.unit = unit
         self._en = en
@@ -119,50 +762,174 @@ class Psrc:
         self._I = I
         self._V = V
         self._R = R
-        self.Utot = 0
-        self.nowP = 0
+        self._t0 = env.now  # 'Utot' counts from here
         self.name = 'Psrc'+str(self.unit)
-        self.data = []
         self.datafile = fname
-        with open(self.datafile, 'r') as f:
-            csvData = csv.reader(f)
-            for row in csvData:
-                try:
-                    self.data.append(
-                            {'time': float(row[0])*Tscale, 
-                             'data': float(row[1])*Pscale})
-                except ValueError:
-                    self.data.append(
-                            {'time': row[0], 'data': row[1]})
-        self.hdr = self.data.pop(0)  # remove and save the header
-        self.env.process(self.run())
-        
-    def run(self):
-        print('SRC start: @ %f' % self.env.now)
-        self.nextSrc = self.data.pop(0)  # prime the dT machine
-        #
-        for row in self.data:
-            self.prevSrc = self.nextSrc
-            self.nextSrc = row
-            sleep = self.nextSrc['time'] - self.prevSrc['time']
-            yield self.env.timeout(sleep)
-        self.prevSrc = self.nextSrc
-        self.nextSrc = None
-        print('SRC stop: @ %f' % self.env.now)
+        if not defined(trace):  # else use a trace already read by 'readTrace'
+            trace = loadTrace(fname) if cache else readTrace(fname)
+        self.hdr, time, data = trace  # header names, then the columns
+        self.Tscale = Tscale
+        self.Pscale = Pscale
+        # scaled copies, as 'trace' may be shared; unscaled stays mapped
+        self.time = time * Tscale if Tscale != 1 else time
+        self.data = data * Pscale if Pscale != 1 else data
+        self._i = 0  # cursor: time[_i] <= env.now < time[_i+1]
+        self._seg = (np.inf, -np.inf, 0.0, 0.0)  # t0, t1, P0, slope at _i
+        self._tnow = None  # env.now of the last interpolation
+        self._Pnow = None
+        self._integrate()
+        self._Ustart = (self._t0, float(self.energy([self._t0])[0]))
+        self.grid = grid
+        self.block = block
+        if defined(grid):
+            # the table starts at env.now, then follows the clock's markers
+            self._gnext = (grid.tTick, grid.tTock)  # not yet in the table
+            self._fill(np.array([env.now]))
+
+    def _integrate(self,U0=0.0):
+        # '_U': energy from the first row to each row, trapezoids being
+        # exact as P is linear between rows
+        if len(self.time) < 2:
+            self._U = np.full(len(self.time), U0)
+            return
+        dU = (self.data[1:] + self.data[:-1]) / 2 * np.diff(self.time)
+        self._U = np.concatenate(([U0], U0 + np.cumsum(dU)))
+
+    def energy(self,times):
+        # energy from the first row to an array of times, held at the end
+        # of the data; as 'interp', extrapolated before the first row
+        times = np.asarray(times, dtype=float)
+        if len(self.time) < 2:
+            return(np.zeros(times.shape))
+        t = np.minimum(times, self.time[-1])
+        i = np.searchsorted(self.time, t, side='right') - 1
+        i = np.clip(i, 0, len(self.time)-2)
+        t0, t1 = self.time[i], self.time[i+1]
+        P0, P1 = self.data[i], self.data[i+1]
+        dt = t - t0
+        return(self._U[i] + P0*dt + (P1-P0)/(t1-t0) * dt*dt/2)
+
+    def _row(self,t):
+        # the table row of time t, None when t is not on the clock grid
+        if t > self._gend:
+            self._extend(t)
+        gt, k = self._gt, self._gk
+        if gt[k] != t:
+            if k+1 < len(gt) and gt[k+1] == t:
+                k += 1  # the usual case: the next marker
+            else:
+                k = min(bisect_left(gt, t), len(gt)-1)
+                if gt[k] != t:
+                    return(None)
+            self._gk = k
+        return(k)
+
+    def _extend(self,t):
+        # the next ticks and tocks, added up as the clock does, to past t
+        per = self.grid.period
+        n = max(self.block, int(ceil((t - self._gend) / per)) + 1)
+        times = []
+        for t0 in self._gnext:
+            steps = np.full(n + 1, per)
+            steps[0] = t0
+            times.append(np.add.accumulate(steps))
+        self._gnext = (times[0].item(-1), times[1].item(-1))
+        self._fill(np.sort(np.concatenate((times[0][:-1], times[1][:-1]))))
+
+    def _fill(self,times):
+        # lists, as they are read one item at a time
+        self._gt = times.tolist()
+        self._gP = self._sample(times).tolist()  # 'P' applies 'on'
+        self._gU = self.energy(times).tolist()
+        self._gk = 0
+        self._gend = self._gt[-1]
+
+    def _seek(self,t):
+        # move the cursor to the row segment [i, i+1] that holds time t
+        i = self._i
+        time = self.time
+        if i+2 < len(time) and time[i+1] <= t < time[i+2]:
+            i += 1  # the usual case: one step forward
+        else:
+            i = int(np.searchsorted(time, t, side='right')) - 1
+            i = min(max(i, 0), len(time)-2)
+        self._i = i
+        t0, t1 = self.time.item(i), self.time.item(i+1)
+        P0, P1 = self.data.item(i), self.data.item(i+1)
+        self._seg = (t0, t1, P0, (P1-P0)/(t1-t0))
+
+    def interp(self,t):
+        # P at time t, None once the data has run out
+        if not (self._seg[0] <= t < self._seg[1]):
+            if len(self.time) < 2 or t > self.time[-1]:
+                return(None)
+            self._seek(t)
+        t0, t1, P0, slope = self._seg
+        return(P0 + slope * (t - t0))
+
+    def sample(self,times):
+        # P at an array of times, NaN once the data has run out
+        times = np.asarray(times, dtype=float)
+        if not self.on:
+            return(np.zeros(times.shape))
+        return(self._sample(times))
+
+    def _sample(self,times):
+        # as 'sample', whether or not the source is on
+        if len(self.time) < 2:
+            return(np.full(times.shape, np.nan))
+        i = np.searchsorted(self.time, times, side='right') - 1
+        i = np.clip(i, 0, len(self.time)-2)
+        t0, t1 = self.time[i], self.time[i+1]
+        P0, P1 = self.data[i], self.data[i+1]
+        P = P0 + (P1-P0)/(t1-t0) * (times - t0)
+        P[times > self.time[-1]] = np.nan
+        return(P)
+
+    @property
+    def exhausted(self):
+        return(len(self.time) < 2 or self.env.now > self.time[-1])
 
     @property
     def Psrc(self):
         # interpolate between two data points for Psrc @ env.now
-        try:
-            delP = self.nextSrc['data'] - self.prevSrc['data']
-            delT = self.nextSrc['time'] - self.prevSrc['time']
-            delNow = self.env.now - self.prevSrc['time']
-            nowP = self.prevSrc['data'] + delP/delT * delNow
-            self.nowP = nowP
-            self.Utot += nowP if self.Utot <= 0.3571 else 0
-            return(nowP)
-        except TypeError:
-            return(None)
+        if self.env.now != self._tnow:
+            t = self._tnow = self.env.now
+            k = self._row(t) if defined(self.grid) else None
+            if not defined(k):  # no table, or off the clock grid
+                P = self.interp(t)
+            else:
+                P = self._gP[k]
+                P = None if P != P else P  # NaN: the data has run out
+            self._Pnow = P
+        return(self._Pnow)
+
+    @property
+    def nowP(self):
+        # P @ env.now, held at the last row once the data has run out
+        P = self.Psrc
+        if not defined(P):
+            return(self.data.item(-1) if len(self.data) else 0)
+        return(P)
+
+    @property
+    def Utot(self):
+        # energy delivered since '_t0', whether or not anything read P
+        if self._Ustart[0] != self._t0:
+            self._Ustart = (self._t0, float(self.energy([self._t0])[0]))
+        t = self.env.now
+        k = self._row(t) if defined(self.grid) else None
+        if defined(k):
+            U = self._gU[k]
+        elif len(self.time) < 2:
+            U = self._U.item(-1) if len(self._U) else 0.0
+        elif not defined(self.interp(t)):  # the data has run out
+            U = self._U.item(-1)
+        else:  # as 'energy', from the cursor of 'interp'
+            t0, t1, P0, slope = self._seg
+            dt = t - t0
+            U = self._U.item(self._i) + P0*dt + slope * dt*dt/2
+        return(U - self._Ustart[1])
     
     @property
     def P(self):
@@ -265,10 +1032,78 @@ class Psrc:
     def en(self,en):
         self._en = en
 
+##############################################################################
+# A Psrc that streams its CSV file in chunks as env.now advances
+# Only a window of 'chunk' rows, plus the last row of the previous window,
+# is held at a time, so multi-GB logger files run in bounded memory.  Time
+# may only move forward past the window; 'sample' wants ascending times.
+# There is no 'grid' table, as it would slide the window past env.now.
+class PsrcStream(Psrc):
+    def __init__(self,env,I=None,V=None,R=None,unit=1,fname="src_data.csv",Tscale=1,Pscale=1,en=True,chunk=65536):
+        self.chunk = chunk
+        self._file = open(fname, 'r', encoding='utf-8-sig', newline='')
+        self._rows = csv.reader(self._file)
+        row = next(self._rows, ['time', 'data'])
+        try:  # a header, as 'readTrace' tells: the first row isn't numbers
+            first = [(float(row[0]), float(row[1]))]
+            hdr = {'time': 'time', 'data': 'data'}
+        except ValueError:
+            first = []
+            hdr = {'time': row[0].strip(), 'data': row[1].strip()}
+        self._eof = False
+        time, data = self._read(first)
+        super().__init__(env,I,V,R,unit,fname,Tscale,Pscale,en,
+                         trace=(hdr, time, data))
+
+    def _read(self,first=()):
+        # the next chunk of rows, unscaled, after any rows 'first'
+        rows = list(first) + [(float(row[0]), float(row[1])) for row in
+                islice(self._rows, self.chunk - len(first)) if row]
+        if len(rows) < self.chunk:
+            self._eof = True
+            self._file.close()
+        data = np.array(rows, dtype=float).reshape(-1, 2)
+        return(data[:, 0], data[:, 1])
+
+    def _advance(self,t):
+        # slide the window on until it holds time t
+        while not self._eof and (len(self.time) < 2 or t >= self.time[-1]):
+            time, data = self._read()
+            if not len(time):  # the last window ended the file: keep it
+                break
+            self.time = np.concatenate((self.time[-1:], time*self.Tscale))
+            self.data = np.concatenate((self.data[-1:], data*self.Pscale))
+            self._integrate(self._U[-1])
+            self._i = 0
+            self._seg = (np.inf, -np.inf, 0.0, 0.0)
+
+    def interp(self,t):
+        if not (self._seg[0] <= t < self._seg[1]):
+            self._advance(t)
+        return(Psrc.interp(self,t))
+
+    def sample(self,times):
+        times = np.asarray(times, dtype=float)
+        P = np.empty(times.shape)
+        j = 0
+        while j < len(times):
+            self._advance(times[j])
+            k = len(times) if self._eof else int(np.searchsorted(
+                    times, self.time[-1], side='right'))
+            P[j:k] = Psrc.sample(self,times[j:k])
+            j = k
+        return(P)
+
+    @property
+    def exhausted(self):
+        return(self._eof and Psrc.exhausted.fget(self))
+
 ##############################################################################
 # An object to create a fixed DC current, voltage or resistive load
 # Note that the 'switch' object can turn this on and off using the 'en' method
 class sink:
+    saved = ('_I', '_V', '_R', '_en')
+    
     def __init__(self,env,I=None,V=None,R=None,unit=1):
         self.env = env
         self.unit = unit
@@ -392,6 +1227,8 @@ class sink:
 ##############################################################################
 # Create a capacitor model
 class cap:
+    saved = ('_Q',)
+    
     def __init__(self,env,val,unit=1):
         self.env = env
         self.unit = unit
@@ -437,11 +1274,99 @@ class cap:
         self._Q += dQ
         return(self._Q)
 
+##############################################################################
+# The harvester's state log, run-length encoded: one row per run of a
+# state, its start time and the state's code in typed arrays.  'end' is
+# the last time the state was seen unchanged, as 'logState' marks the end
+# of a run.  log['time'] and log['data'] expand it to the two-entries-per-
+# change lists of times and state names, to plot as before
+class stateLog:
+    def __init__(self,t=0,state=st['off']):
+        self.start = array('d', [t])  # start time of each run
+        self.code = array('b', [codes[state]])  # its state
+        self.end = None  # the state last seen unchanged, at this time
+
+    def append(self,t,state):
+        c = codes[state]
+        if c == self.code[-1]:
+            self.end = t
+        else:
+            self.start.append(t)
+            self.code.append(c)
+            self.end = None
+
+    @classmethod
+    def fromRuns(cls,start,code,end=None):
+        log = cls()
+        log.start = array('d', np.asarray(start, dtype=float).tolist())
+        log.code = array('b', np.asarray(code, dtype=int).tolist())
+        log.end = end
+        return(log)
+
+    def __len__(self):
+        return(len(self.start))  # runs
+
+    def __eq__(self,other):
+        return(isinstance(other, stateLog) and self.start == other.start
+               and self.code == other.code and self.end == other.end)
+
+    def __getitem__(self,key):
+        # 'time', 'data': lists as the log was once kept
+        t = self.start.tolist()
+        s = [names[c] for c in self.code]
+        if key == 'time':
+            out = t[:1] + [x for x in t[1:] for i in (0, 1)]
+        elif key == 'data':
+            out = s[:1] + [x for pair in zip(s, s[1:]) for x in pair]
+        else:
+            raise KeyError(key)
+        if defined(self.end):
+            out.append(self.end if key == 'time' else s[-1])
+        return(out)
+
+    def runs(self,until=None):
+        # start times, codes and durations of the runs, as arrays; the
+        # last run lasts to 'until', or to the last time it was seen
+        start = np.frombuffer(self.start, dtype=float)
+        code = np.frombuffer(self.code, dtype=np.int8)
+        last = until if defined(until) else (
+                self.end if defined(self.end) else start[-1])
+        dur = np.diff(np.append(start, max(last, start[-1])))
+        return(start, code, dur)
+
+    def residency(self,until=None):
+        # seconds spent in each state
+        start, code, dur = self.runs(until)
+        t = np.bincount(code, weights=dur, minlength=len(names))
+        return({names[i]: float(t[i]) for i in range(len(names))})
+
+    def transitions(self):
+        # number of changes from state to state, {(from, to): count}
+        code = np.frombuffer(self.code, dtype=np.int8).astype(int)
+        pair = code[:-1]*len(names) + code[1:]
+        n = np.bincount(pair, minlength=len(names)**2)
+        return({(names[i // len(names)], names[i % len(names)]): int(n[i])
+                for i in np.flatnonzero(n)})
+
+    def first(self):
+        # the first time each state was entered, None if never
+        start, code, dur = self.runs()
+        out = {}
+        for i, name in enumerate(names):
+            k = np.flatnonzero(code == i)
+            out[name] = float(start[k[0]]) if len(k) else None
+        return(out)
+
 ##############################################################################
 # Create a model of the harvester half of the bq25570, the input
 # Collected data is stored in capacitors, 'stor' and 'bat'
 class harvester():
-    def __init__(self,env,clk,inp,stor,bat,unit=1,en=True):
+    saved = ('state', 'stateLog', '_en', 'next_Pin', '_batOK', 'predict',
+             '_Vtick', '_Vcross', '_tlag', '_Pstart', '_tswitch', '_twake',
+             '_dQ', '_dU', 'ticking')
+    
+    def __init__(self,env,clk,inp,stor,bat,unit=1,en=True,predict=False,
+                 start=True):
         self.env = env
         self.clock = clk
         self.unit = unit
@@ -454,7 +1379,7 @@ class harvester():
         # state variable
         # states: off, cold, warm, full
         self.state = st['off']
-        self.stateLog = {'time': [0], 'data': [self.state]}
+        self.stateLog = stateLog(0, self.state)
         # circuit parameters
         self._en = en  # enable bit
         self.Zin = self.inp.Zsrc  # Internal impedance, facing SRC [historical]
@@ -469,31 +1394,52 @@ class harvester():
         self.bat_ov = 5.5  # battery overvoltage limit -- turn off boost
         # Is Cstor&Cbat got enough charge on 'em?
         self._batOK = False
+        # predict threshold crossings between tocks, rather than polling
+        self.predict = predict
+        self._Vtick = None  # (time, Vstor) at the last tick seen by 'tock'
+        self._Vcross = None  # Vstor to evaluate at the predicted crossing
+        self._tlag = 0  # how far the ticks' energy runs ahead, see 'nextCross'
+        self._Pstart = None  # input P when the state was entered
+        self._tswitch = None  # (time, loss, state) of a change between ticks
+        self._twake = None  # predicted crossing being waited for
+        self.ledger = None  # energy accounts, see 'ledger'
+        self.ticking = False  # 'run' holds the clock
         # debug parameters
         self._dQ = 0
         self._dU = 0
         # start collecting energy
-        self.env.process(self.run())
-        self.env.process(self.nextState())
-    
-    def run(self):  # runs on its own, off of 'tick'
-        # precharge the battery
-        self.bat.V = self.chgen
+        if start:
+            self.env.process(self.run())
+            self.env.process(self.nextState())
+    
+    def resume(self):
+        # carry on from a state set by 'setState', between tock and tick
+        if self.ticking:
+            self.env.process(self.run(resume=True))
+        self.env.process(self.nextState(resume=True))
+    
+    def run(self,resume=False):  # runs on its own, off of 'tick'
+        if not resume:
+            # precharge the battery
+            self.bat.V = self.chgen
         #
         self.clock.start(self)
-        gen = self.nextQ()
+        self.ticking = True
+        gen = resume or self.nextQ()
         while gen:
             yield self.clock.tick
             self._dQ = 0  # for debug
             self._dU = 0  # for debug
             gen = self.nextQ()
         self.clock.stop(self)
+        self.ticking = False
     
     def nextQ(self):
         self.prev_Pin = self.next_Pin
         self.next_Pin = {'time': self.env.now, 'data': self.inp.P}
         gen = defined(self.next_Pin['data'])
         if gen:
+            P = self.next_Pin['data']
             self.next_Pin['data'] *= 1-self.loss
             # Vc*Ic = P = Vi*Ii; 
             # U = P*T
@@ -507,8 +1453,20 @@ class harvester():
             # dQ = Q1 - Q0
             dT = self.next_Pin['time'] - self.prev_Pin['time']
             dU = self.next_Pin['data']*dT
+            dU0 = 0  # stored before a state change part way into dT
+            if defined(self._tswitch):  # the part before 'tsw' had the old
+                tsw, loss, state = self._tswitch  # state and loss
+                self._tswitch = None
+                dT0 = min(max(tsw - self.prev_Pin['time'], 0), dT)
+                if state == st['cold'] or state == st['warm']:
+                    dU0 = P * (1-loss) * dT0
+                if self.ledger:
+                    self.ledger.harvest(state, P*dT0, dU0)
+                dT -= dT0
+                dU = self.next_Pin['data']*dT
+            charging = self.state == st['cold'] or self.state == st['warm']
             U0 = self.stor.U
-            Q1 = sqrt((U0 + dU)*2*self.stor.C)
+            Q1 = sqrt((U0 + dU0 + (dU if charging else 0))*2*self.stor.C)
             Q0 = self.stor.Q
             dQ = Q1 - Q0
             if self.state == st['cold']:
@@ -516,10 +1474,15 @@ class harvester():
             elif self.state == st['warm']:
                 self.boost(dQ)
             elif self.state == st['full']:
-                self.balance(self.stor, self.bat)  # share charge w/bat
-            else:
-                None
+                if dU0:  # boost what came in before, then share
+                    self.boost(dQ)
+                else:
+                    self.balance(self.stor, self.bat)  # share charge w/bat
+            elif dU0:
+                self.boost(dQ)
             self._dU = dU
+            if self.ledger:
+                self.ledger.harvest(self.state, P*dT, dU)
         return(gen)
     
     def boost(self,dQ):
@@ -533,12 +1496,18 @@ class harvester():
         self._dQ = dQ  # for debug
     
     def balance(self,C1,C2):  # balance charge so that Vstor == Vbat
+        if self.ledger:
+            U0 = C1.U + C2.U
         dQ = (C1.Q * C2.C - C2.Q * C1.C) / (C1.C + C2.C)
         C1.addQ(-dQ)
         C2.addQ(dQ)
+        if self.ledger:
+            U1 = C1.U + C2.U
         if self.stor.V >= self.bat_ov:
             self.stor.V = self.bat_ov
             self.bat.V = self.bat_ov
+        if self.ledger:
+            self.ledger.balance(U0 - U1, U1 - (C1.U + C2.U))
     
     def sinkU(self,dU):
         # dU = P*dT = U1-U0
@@ -555,34 +1524,89 @@ class harvester():
         dQ = Q1 - Q0
         self.boost(dQ)
 
-    def nextState(self):  # runs on its own, off of 'tock'
+    def nextState(self,resume=False):  # runs on its own, off of 'tock'
         while self.clock.running:
-            # measure the battery voltage
-            self._batOK = (self.stor.V >= self.bat_ok)
-            #
-            # update the state machine
-            _prevState = self.state
-            if not self.en:
-                self.state = st['off']
-            elif self.stor.V < self.chgen:
-                self.state = st['cold']
-            elif self.stor.V < self.bat_ov*0.999:
-                self.state = st['warm']
-            elif self.stor.V >= self.bat_ov*0.999:
-                self.state = st['full']
+            if resume:  # already updated on this tock
+                changed, tcross, resume = True, self._twake, False
             else:
-                print('ERROR: state: no state found')
-            if _prevState != self.state:  # log the state change
-                self.logState(_prevState)
-                self.logState()
-            yield self.clock.tock
+                changed, tcross = self.updateState(), None
+            tock = self.clock.tock
+            if self.predict and not changed:  # wake up at the next crossing
+                tcross = self.nextCross()
+            if defined(tcross):
+                self._twake = tcross
+                yield self.env.timeout(timeTo(self.env, tcross))
+                self._twake = None
+                self.updateState(self._Vcross)
+            yield tock
         #print('WARNING: nextState exiting!')
-    
+
+    def updateState(self,V=None):
+        if not defined(V):
+            V = self.stor.V  # measure the battery voltage
+        self._batOK = (V >= self.bat_ok)
+        #
+        # update the state machine
+        _prevState = self.state
+        _prevLoss = self.loss
+        if not self.en:
+            self.state = st['off']
+        elif V < self.chgen:
+            self.state = st['cold']
+        elif V < self.bat_ov*0.999:
+            self.state = st['warm']
+        elif V >= self.bat_ov*0.999:
+            self.state = st['full']
+        else:
+            print('ERROR: state: no state found')
+        if _prevState != self.state:  # log the state change
+            self.logState(_prevState)
+            self.logState()
+            if self.predict and defined(self._Vcross):
+                self._tswitch = (self.env.now - self._tlag, _prevLoss,
+                                 _prevState)
+            if self.predict:
+                self._Pstart = self.inp.P
+            self._Vtick = None  # the old rate no longer applies
+        self._Vcross = None
+        return(_prevState != self.state)
+
+    def nextCross(self):
+        # Vstor moves only on 'tick'; extrapolate the stored energy (~V^2)
+        # over the last tick to find the first threshold crossed before
+        # the next tick.  Only rates seen within one state are trusted.
+        t1, V1 = self.next_Pin['time'], self.stor.V
+        prev, self._Vtick = self._Vtick, (t1, V1)
+        if not defined(prev) or t1 <= prev[0] or V1 == prev[1]:
+            return(None)
+        dT = t1 - prev[0]
+        rate = (V1**2 - prev[1]**2) / dT
+        # each tick adds its end-of-tick P for all of dT, so since the state
+        # began the stored energy has run ahead of the trace's integral by
+        # (P1 - Pstart)*dT/2: V1 is where the trace puts Vstor 'lag' later
+        lag = 0
+        if self.loss < 1 and defined(self._Pstart) and self.next_Pin['data']:
+            P1 = self.next_Pin['data'] / (1-self.loss)
+            lag = min(max((1 - self._Pstart/P1) * dT/2, -dT/2), dT/2)
+        tnext = t1 + self.clock.period
+        tcross = None
+        for thr in (self.chgen, self.bat_ok, self.bat_ov*0.999):
+            if thr == self.bat_ov*0.999 and rate > 0:
+                continue  # 'full' adds no input, so polling finds it
+            if (rate > 0 and V1 < thr) or (rate < 0 and V1 >= thr):
+                tc = t1 + lag + (thr**2 - V1**2)/rate
+                if tc < tnext and (not defined(tcross) or tc < tcross):
+                    tcross = tc
+                    self._Vcross = thr if rate > 0 else nextafter(thr, 0)
+        if not defined(tcross):
+            return(None)
+        self._tlag = lag
+        return(max(tcross, self.env.now))
+
     def logState(self,state=None):
         if not defined(state):
             state = self.state
-        self.stateLog['time'].append(self.env.now)
-        self.stateLog['data'].append(state)
+        self.stateLog.append(self.env.now, state)
 
     @property
     def loss(self):
@@ -636,7 +1660,9 @@ class harvester():
 # Create a model of the buck converter half of the bq25570, the output
 # Energy is drawn from 'stor' capacitor, via 'sinkU' method in 'harvester'
 class converter:
-    def __init__(self,env,clock,Estor,Vout,Iout,unit=1,en=True):
+    saved = ('_en', 'next_Pout', '_dU', 'ticking')
+    
+    def __init__(self,env,clock,Estor,Vout,Iout,unit=1,en=True,start=True):
         self.env = env
         self.clock = clock
         self.unit = unit
@@ -656,15 +1682,24 @@ class converter:
         self.bat_ok = Estor.bat_ok
         # debug parameters
         self._dU = 0
+        self.ticking = False  # 'run' holds the clock
+        self.ledger = None  # energy accounts, see 'ledger'
         # start collecting energy
-        self.env.process(self.run())
+        if start:
+            self.env.process(self.run())
     
-    def run(self):
+    def resume(self):
+        # carry on from a state set by 'setState', between tock and tick
+        if self.ticking:
+            self.env.process(self.run(resume=True))
+    
+    def run(self,resume=False):
         # tell the power source the output voltage
         self._I.V = self._V
         #
         self.clock.start(self)
-        gen = self.nextU()
+        self.ticking = True
+        gen = resume or self.nextU()
         while gen:
             if self.clock.running:
                 yield self.clock.tick
@@ -672,6 +1707,7 @@ class converter:
             else:
                 gen = False
         self.clock.stop(self)
+        self.ticking = False
     
     def nextU(self):
         self.prev_Pout = self.next_Pout
@@ -686,7 +1722,10 @@ class converter:
     
     def buck(self,dU):
         if self.on:
+            mark = self.ledger.mark() if self.ledger else None
             self.Estor.sinkU(dU)
+            if self.ledger:
+                self.ledger.buck(-dU, self.loss, mark)
         self._dU = dU  # for debug
     
     @property
@@ -725,6 +1764,95 @@ class converter:
     def en(self, en):
         self._en = en
 
+##############################################################################
+# Energy accounts of a harvester and its converter, kept as running sums
+# while they run; nothing is stored per tick.  The harvester and converter
+# report to it once 'ledger' hooks them up
+#   input:     energy of the source, on ticks where it had data
+#   loss_cold, loss_warm: lost in the boost converter, by state
+#   dropped:   input while the boost was off or full, not stored
+#   sharing:   lost when Cstor and Cbat balance charge
+#   clipped:   lost when 'balance' clamps both caps at bat_ov
+#   buck_loss: lost in the buck converter
+#   load:      delivered to the load
+#   stored:    change of the energy in Cstor and Cbat
+#   residual:  input less all of the above, the model's conservation error
+# Every n-th tock a summary row is added to 'rows' and passed to 'emit';
+# 'add' adds one at any time, e.g. at the end of a run
+class ledger:
+    keys = ('input', 'loss_cold', 'loss_warm', 'dropped', 'sharing',
+            'clipped', 'buck_loss', 'load')
+    
+    def __init__(self,env,clock,hvst,cnvtr=None,every=1000,emit=None):
+        self.env = env
+        self.clock = clock
+        self.hvst = hvst
+        self.cnvtr = cnvtr
+        self.every = every
+        self.emit = emit
+        self.name = 'Ledger'
+        self.sums = dict.fromkeys(self.keys, 0.0)
+        self.U0 = hvst.Ustored  # stored energy at the start
+        self.rows = []
+        hvst.ledger = self
+        if defined(cnvtr):
+            cnvtr.ledger = self
+        if every:
+            self.env.process(self.run())
+    
+    def harvest(self,state,Uin,dU):
+        s = self.sums
+        s['input'] += Uin
+        if state == st['cold']:
+            s['loss_cold'] += Uin - dU
+        elif state == st['warm']:
+            s['loss_warm'] += Uin - dU
+        else:
+            s['dropped'] += Uin
+    
+    def balance(self,shared,clipped):
+        self.sums['sharing'] += shared
+        self.sums['clipped'] += clipped
+    
+    def mark(self):
+        # before 'sinkU', for 'buck'
+        return(self.hvst.Ustored, self.sums['sharing'], self.sums['clipped'])
+    
+    def buck(self,dU,loss,mark):
+        # 'sinkU' draws dU from Cstor and Cbat as one; whatever else left
+        # them on the way, through its 'balance' or not, is sharing loss
+        U0, shared, clipped = mark
+        self.sums['buck_loss'] += dU * loss
+        self.sums['load'] += dU * (1-loss)
+        self.sums['sharing'] = shared + (U0 - self.hvst.Ustored - dU)
+        self.sums['clipped'] = clipped
+    
+    def summary(self):
+        # the accounts so far
+        out = {'time': self.env.now}
+        out.update(self.sums)
+        out['stored'] = self.hvst.Ustored - self.U0
+        out['residual'] = out['input'] - sum(
+                out[k] for k in self.keys[1:]) - out['stored']
+        return(out)
+    
+    def run(self):
+        self.U0 = self.hvst.Ustored  # after harvester.run precharged Cbat
+        n = 0
+        while self.clock.running:
+            yield self.clock.tock
+            n += 1
+            if n % self.every == 0:
+                self.add()
+    
+    def add(self):
+        # a summary row now, unless there is one already
+        if not self.rows or self.rows[-1]['time'] != self.env.now:
+            self.rows.append(self.summary())
+            if self.emit:
+                self.emit(self.rows[-1])
+        return(self.rows[-1])
+
 ##############################################################################
 ##############################################################################
 ##############################################################################
@@ -732,10 +1860,117 @@ class converter:
 
 # A useful function to sum two lists (better way?)
 def list_m(a, b):
-    c = []
-    for i in range(len(a)):
-        c.append(a[i]+b[i])
-    return(c)
+    # element by element a+b, as a list; see 'Trace' for arithmetic on probes
+    return((np.asarray(a) + np.asarray(b)[:len(a)]).tolist())
 
 def defined(var):
-    return(var != None)
\ No newline at end of file
+    return(var != None)
+
+# The delay from env.now that lands exactly on time 't'
+def timeTo(env,t):
+    d = t - env.now
+    while env.now + d != t:  # not exact when 't' is far from env.now
+        d = nextafter(d, np.inf if env.now + d < t else -np.inf)
+    return(d)
+
+# Checkpoints: the attributes named in a class's 'saved' tuple are the
+# state that a fresh object needs to carry on from where another one was
+def getState(obj):
+    return({name: copy.deepcopy(getattr(obj, name)) for name in obj.saved})
+
+def setState(obj,state):
+    for name in obj.saved:
+        if name in state:
+            setattr(obj, name, copy.deepcopy(state[name]))
+
+# Read a trace: its header names, then time and data arrays
+# From a CSV file, time and data are the first two columns and the header
+# row is optional; a compiled '.npy' trace is memory-mapped instead
+def readTrace(fname):
+    if fname.endswith('.npy'):
+        return(loadTrace(fname))
+    with open(fname, 'r', encoding='utf-8-sig', newline='') as f:
+        row = next(csv.reader([f.readline()]), ['time', 'data'])
+        try:
+            first = [(float(row[0]), float(row[1]))]
+            hdr = {'time': 'time', 'data': 'data'}
+        except ValueError:
+            first = []
+            hdr = {'time': row[0].strip(), 'data': row[1].strip()}
+        data = np.loadtxt(f, delimiter=',', usecols=(0, 1), ndmin=2)
+    data = np.concatenate((np.array(first).reshape(-1, 2), data))
+    return(hdr, data[:, 0].copy(), data[:, 1].copy())
+
+# Compiled traces: a (2, n) float64 '.npy' file, the time row then the data
+# row, and a '.json' file beside it with the header names and the size,
+# mtime and SHA-1 of the CSV it came from.  By default they live in a
+# '__tracecache__' folder next to the CSV.
+traceCache = '__tracecache__'
+
+def tracePath(fname):
+    head, tail = os.path.split(fname)
+    return(os.path.join(head, traceCache, tail + '.npy'))
+
+def _traceMeta(npy):
+    return(npy[:-len('.npy')] + '.json' if npy.endswith('.npy') else (
+            npy + '.json'))
+
+def _sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return(h.hexdigest())
+
+def compileTrace(fname,npy=None):
+    # convert a CSV trace to its binary form; returns the '.npy' path
+    npy = npy or tracePath(fname)
+    hdr, time, data = readTrace(fname)
+    stat = os.stat(fname)
+    meta = {'hdr': hdr, 'source': os.path.basename(fname),
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': _sha1(fname), 'rows': len(time)}
+    os.makedirs(os.path.dirname(os.path.abspath(npy)), exist_ok=True)
+    tmp = '%s.%d.tmp' % (npy, os.getpid())  # many workers may race here
+    with open(tmp, 'wb') as f:
+        np.save(f, np.vstack((time, data)))
+    os.replace(tmp, npy)
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, _traceMeta(npy))
+    return(npy)
+
+def loadTrace(fname,mmap=True):
+    # a trace from a '.npy' file, or from a CSV file via its compiled copy,
+    # which is rebuilt when the CSV's size/mtime and SHA-1 have changed
+    npy = fname
+    if not fname.endswith('.npy'):
+        npy = tracePath(fname)
+        try:
+            with open(_traceMeta(npy)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        stat = os.stat(fname)
+        fresh = os.path.exists(npy) and meta.get('size') == stat.st_size
+        if fresh and meta.get('mtime_ns') != stat.st_mtime_ns:
+            fresh = meta.get('sha1') == _sha1(fname)  # touched, not changed
+            if fresh:
+                meta['mtime_ns'] = stat.st_mtime_ns
+                try:
+                    with open(_traceMeta(npy), 'w') as f:
+                        json.dump(meta, f, indent=1)
+                except OSError:
+                    pass  # still fresh; the SHA-1 is checked again next time
+        if not fresh:
+            try:
+                compileTrace(fname, npy)
+            except OSError:  # e.g. a read-only data folder: use the CSV
+                return(readTrace(fname))
+    try:
+        with open(_traceMeta(npy)) as f:
+            hdr = json.load(f)['hdr']
+    except (OSError, ValueError, KeyError):
+        hdr = {'time': 'time', 'data': 'data'}
+    arr = np.load(npy, mmap_mode='r' if mmap else None)
+    return(hdr, arr[0], arr[1])
\ No newline at end of file
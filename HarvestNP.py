@@ -0,0 +1,847 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized NumPy engines for the Harvest3 component models
+"""
+
+from math import sqrt, ceil, isnan
+import numpy as np
+import Harvest3 as hvst
+from Harvest3 import st, defined, codes, names
+
+##############################################################################
+# A fixed-step engine that advances the bq25570 models in NumPy chunks
+#
+# Takes the same component objects that the SimPy path uses and reproduces
+# the tick/tock schedule of 'clock': harvester.nextQ and converter.nextU on
+# every tick, harvester.nextState on every tock.  Within a chunk the state
+# machine is held constant; the chunk is cut at the first tock where the
+# state (or batOK) changes, at OnOff toggles and where an input runs dry.
+# Stretches where the state chatters are stepped by a scalar loop instead.
+#
+# With 'adaptive' set, stretches that need no tick-by-tick work are leapt
+# over in closed form: idle time, cold charging of Cstor and pure draining
+# of Cstor||Cbat by the converter.  The tick sums of a Psrc that is linear
+# between two breakpoints are quadratic in the tick count, so a leap runs
+# to the next breakpoint, OnOff toggle or threshold crossing in one go and
+# records a single tock at its end.
+class engine:
+    def __init__(self,hvst_obj,cnvtr=None,switch=None,chunk=4096,minrun=16,
+                 every=1,tol=1e-12,adaptive=False):
+        self.hvst = hvst_obj
+        self.cnvtr = cnvtr
+        self.switch = [] if switch is None else (
+                switch if isinstance(switch, (list, tuple)) else [switch])
+        self.env = hvst_obj.env
+        self.clock = hvst_obj.clock
+        self.period = self.clock.period
+        self.Tpost = self.clock.Tpost
+        self.chunk = chunk  # ticks per vectorized chunk
+        self.minrun = minrun  # shorter runs than this are stepped in scalar
+        self.every = every  # record every n-th tock
+        self.tol = tol  # convergence of the chunk iteration, volts
+        self.adaptive = adaptive  # leap over idle/linear stretches
+        self.load = cnvtr._I if defined(cnvtr) else None
+        self.nChunk = 0  # debug: vectorized chunks accepted
+        self.nScalar = 0  # debug: ticks stepped in scalar
+        self.nLeap = 0  # debug: closed-form leaps taken
+        self.diff = None
+
+    def run(self,until,check=False,commit=True):
+        self._solve(until)
+        if check:
+            self._check(until)
+        elif commit:
+            self._commit()
+        return(self)
+
+    ##########################################################################
+    # input sampling
+
+    def _trace(self,src):
+        # a PsrcStream holds only a window of its file: read all of it
+        if isinstance(src, hvst.PsrcStream):
+            hdr, time, data = hvst.readTrace(src.datafile)
+            return(time * src.Tscale, data * src.Pscale)
+        return(src.time, src.data)
+
+    def _sample(self,src,trace,t):
+        # Psrc.P at times 't', NaN once the data has run out
+        if src is None:
+            return(np.zeros(len(t)))
+        if isinstance(src, hvst.sink):
+            P = src.P
+            return(np.full(len(t), P if defined(P) else np.nan))
+        tt, pp = trace
+        P = np.interp(t, tt, pp)
+        P[t > tt[-1]] = np.nan
+        return(P)
+
+    def _enable(self,obj,t):
+        # 'en' of 'obj' at times 't', following any OnOff switching it
+        en = np.full(len(t), bool(obj.en)) if defined(obj) else np.ones(
+                len(t), dtype=bool)
+        for sw in self.switch:
+            if sw.obj is obj:
+                flips = np.searchsorted(self._toggles[id(sw)], t, side='right')
+                en ^= (flips % 2).astype(bool)
+        return(en)
+
+    ##########################################################################
+    # the solver
+
+    def _solve(self,until):
+        H = self.hvst
+        Cs, Cb = H.stor.C, H.bat.C
+        self._Cs, self._Cb = Cs, Cb
+        self._toggles = {id(sw): np.cumsum(sw.doList) for sw in self.switch}
+        self._in = self._trace(H.inp)
+        self._ld = self._trace(self.load) if isinstance(
+                self.load, hvst.Psrc) else None
+        if defined(self.cnvtr):  # as converter.run does
+            self.load.V = self.cnvtr._V
+        # state at t=0, as harvester.run and the first nextState leave it
+        self.Qs = H.stor.Q
+        self.Qb = Cb * H.chgen  # precharge the battery
+        self.aliveH = True
+        self.aliveC = defined(self.cnvtr)
+        self.k = 0
+        self.tk = 0.0  # time of the next tick
+        self.tLast = 0.0
+        en0 = self._enable(H, np.zeros(1))[0]
+        self.state = self._eval(self.Qs / Cs, en0)
+        self.batOK = self.Qs / Cs >= H.bat_ok
+        self.log = [] if self.state == H.state else [
+                (0, H.state), (0, self.state)]
+        self._rec = []
+        self._recPhase = 0
+        while self._leap(until) or self._block(until):
+            None
+
+    def _grid(self,n):
+        # the next n tick times, accumulated like env.now + period
+        t = np.full(n, self.period)
+        t[0] = self.tk
+        return(np.cumsum(t))
+
+    def _eval(self,V,en):
+        # harvester.nextState for a stor voltage V
+        H = self.hvst
+        if not en:
+            return(st['off'])
+        elif V < H.chgen:
+            return(st['cold'])
+        elif V < H.bat_ov*0.999:
+            return(st['warm'])
+        else:
+            return(st['full'])
+
+    def _segment(self,src,trace,t0):
+        # (P(t0), slope, end) of the Psrc line that holds at t0
+        if isinstance(src, hvst.sink):
+            P = src.P
+            return(None if not defined(P) else (P, 0.0, np.inf))
+        tt, pp = trace
+        i = max(np.searchsorted(tt, t0, side='right') - 1, 0)
+        if i >= len(tt) - 1 or tt[i+1] <= tt[i]:
+            return(None)
+        m = (pp[i+1] - pp[i]) / (tt[i+1] - tt[i])
+        return(pp[i] + m*(t0 - tt[i]), m, tt[i+1])
+
+    def _leap(self,until):
+        # closed-form advance to the next event; False if none applies here
+        if not self.adaptive or self.k == 0:
+            return(False)
+        H, C = self.hvst, self.cnvtr
+        per = self.period
+        t0 = self.tk
+        if t0 >= until:
+            return(False)
+        t = np.array([t0])
+        en = [self._enable(obj, t)[0] for obj in (H, C, H.inp, self.load)]
+        enH, enC = en[0], (en[1] if defined(C) else False)
+        s = self.state
+        Cs, Cb = self._Cs, self._Cb
+        Ct = Cs + Cb
+        cv = self.aliveC and enC and self.batOK
+        # the next event: until, an OnOff toggle, a Psrc breakpoint
+        horizon = until
+        for tog in self._toggles.values():
+            later = tog[tog > t0]
+            if len(later):
+                horizon = min(horizon, later[0])
+        a = b = 0.0  # energy per tick: a + b*j for the j-th tick
+        if self.aliveH and s in (st['cold'], st['warm']) and en[2]:
+            seg = self._segment(H.inp, self._in, t0)
+            if seg is None:
+                return(False)
+            P0, m, tb = seg
+            if P0 != 0 or m != 0:
+                if s == st['warm'] or cv:
+                    return(False)  # charge sharing is stepped per tick
+                c = 1 - self._loss(s)
+                a, b = c*P0*per, c*m*per*per
+                horizon = min(horizon, tb)
+        if cv:
+            if s not in (st['warm'], st['full']):
+                return(False)
+            P0, m, tb = 0.0, 0.0, np.inf
+            if en[3]:
+                seg = self._segment(self.load, self._ld, t0)
+                if seg is None:
+                    return(False)
+                P0, m, tb = seg
+            c = 1 / (1-C.loss)
+            a, b = -c*P0*per, -c*m*per*per
+            horizon = min(horizon, tb)
+        n = int(ceil((horizon - t0)/per - 1e-9))
+        if n < 1:
+            return(False)
+        # energy after n ticks, and the crossings that end the leap
+        if cv:
+            if abs(self.Qs/Cs - self.Qb/Cb) > 1e-9*max(self.Qb/Cb, 1):
+                return(False)
+            E0 = (self.Qs + self.Qb)**2 / (2*Ct)
+            Vof = lambda E: sqrt(2*max(E, 0)/Ct)
+            thr = [H.bat_ok]
+            thr += [H.chgen] if s == st['warm'] else [H.bat_ov*0.999]
+            crossed = lambda V: any(V < x for x in thr)
+        else:
+            E0 = self.Qs**2 / (2*Cs)
+            Vof = lambda E: sqrt(2*max(E, 0)/Cs)
+            crossed = lambda V: (self._eval(V, enH) != s or
+                                 (V >= H.bat_ok) != self.batOK)
+        En = lambda j: E0 + a*j + b*j*(j-1)/2
+        if crossed(Vof(En(1))):
+            return(False)  # let the chunk path take the crossing tick
+        if crossed(Vof(En(n))):  # E is monotone in j: bisect the crossing
+            lo, hi = 1, n
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if crossed(Vof(En(mid))):
+                    hi = mid
+                else:
+                    lo = mid
+            n = hi
+        V = Vof(En(n))
+        if cv:
+            V = min(V, H.bat_ov)
+            self.Qs, self.Qb = Cs*V, Cb*V
+        else:
+            self.Qs = Cs*V
+        tn = t0 + (n-1)*per
+        self.k += n
+        self.tLast = tn
+        self.tk = tn + per
+        self._record(np.array([tn]), np.array([self.Qs]),
+                     np.array([self.Qb]), cv)
+        self._tock(tn, enH)
+        self.nLeap += 1
+        return(True)
+
+    def _block(self,until):
+        # advance one chunk of ticks; False once the clock stops
+        H, C = self.hvst, self.cnvtr
+        t = self._grid(1 if self.adaptive and self.k == 0 else self.chunk)
+        t = t[t < until]
+        if len(t) == 0:
+            return(False)
+        # cut the chunk where any OnOff flips an enable
+        en = [self._enable(obj, t) for obj in (H, C, H.inp, self.load)]
+        n = len(t)
+        for e in en:
+            flip = np.flatnonzero(e != e[0])
+            if len(flip):
+                n = min(n, flip[0])
+        t = t[:n]
+        enH, enC = en[0][0], (en[1][0] if defined(C) else False)
+        Pin = self._sample(H.inp, self._in, t)
+        Pin[~en[2][:n]] = 0
+        Pld = self._sample(self.load, self._ld, t)
+        if defined(self.load):
+            Pld[~en[3][:n]] = 0
+        dT = np.full(n, self.period)
+        dT[0] = t[0] - self.tLast
+        # the stretch up to the next input running dry
+        if self.aliveH:
+            dry = np.flatnonzero(np.isnan(Pin))
+            if len(dry) and dry[0] == 0:
+                self.aliveH = False  # harvester.run exits, clock.stop
+            elif len(dry):
+                n = dry[0]
+        if self.aliveC and enC and self.batOK and isnan(Pld[0]):
+            self.aliveC = False  # converter.run exits, clock.stop
+        if not self.aliveH and not self.aliveC:
+            return(False)  # clock stops
+        if self.aliveC:
+            dry = np.flatnonzero(np.isnan(Pld[:n]))
+            if len(dry) and dry[0] > 0:
+                n = dry[0]
+        sl = slice(0, n)
+        args = (t[sl], dT[sl], Pin[sl], Pld[sl], enH, enC)
+        done = self._vector(*args)
+        if done < min(self.minrun, n):
+            done = self._scalar(*args)
+        self.k += done
+        self.tLast = t[done-1]
+        self.tk = self.tLast + self.period
+        return(True)
+
+    def _loss(self,state):
+        H = self.hvst
+        if state == st['cold']:
+            return(H.loss_cold)
+        elif state in (st['warm'], st['full']):
+            return(H.loss_warm)
+        return(1)
+
+    def _vector(self,t,dT,Pin,Pld,enH,enC):
+        # closed-form or iterated chunk for a constant state; returns the
+        # number of ticks accepted, 0 if this regime is left to '_scalar'
+        H = self.hvst
+        Cs, Cb = self._Cs, self._Cb
+        Ct = Cs + Cb
+        s = self.state
+        hv = self.aliveH and s in (st['cold'], st['warm'])
+        bal = self.aliveH and s in (st['warm'], st['full'])
+        cv = self.aliveC and enC and self.batOK
+        n = len(t)
+        if n == 0:
+            return(0)
+        dUin = Pin * (1-self._loss(s)) * dT
+        if cv:
+            dUout = Pld / (1-self.cnvtr.loss) * dT
+        if s == st['cold'] and not cv:
+            if hv:
+                Us = self.Qs**2/(2*Cs) + np.cumsum(dUin)
+                Qs = np.sqrt(Us*2*Cs)
+            else:
+                Qs = np.full(n, self.Qs)
+            Qb = np.full(n, self.Qb)
+        elif s in (st['warm'], st['full']) and (bal or cv):
+            Vs0, Vb0 = self.Qs/Cs, self.Qb/Cb
+            if abs(Vs0 - Vb0) > 1e-9*max(Vs0, Vb0, 1):
+                return(0)  # first tick out of 'cold' balances in '_scalar'
+            V0 = (self.Qs + self.Qb) / Ct
+            V = self._iterate(V0, dUin, dUout if cv else None, hv, Cs, Ct)
+            if V is None:
+                return(0)
+            Qs, Qb = Cs*V, Cb*V
+        elif not hv and not bal and not cv:
+            Qs = np.full(n, self.Qs)
+            Qb = np.full(n, self.Qb)
+        else:
+            return(0)
+        # harvester.nextState on the tock following each tick
+        Vs = Qs / Cs
+        if not enH:
+            cut = np.zeros(n, dtype=bool)
+        elif s == st['cold']:
+            cut = Vs >= H.chgen
+        elif s == st['warm']:
+            cut = (Vs < H.chgen) | (Vs >= H.bat_ov*0.999)
+        elif s == st['full']:
+            cut = Vs < H.bat_ov*0.999
+        else:
+            cut = np.zeros(n, dtype=bool)
+        cut |= (Vs >= H.bat_ok) != self.batOK
+        if s == st['off'] and enH:
+            cut[:] = True
+        hit = np.flatnonzero(cut)
+        done = hit[0] + 1 if len(hit) else n
+        if done < min(self.minrun, n) and len(hit):
+            return(0)
+        self.Qs, self.Qb = Qs[done-1], Qb[done-1]
+        self._record(t[:done], Qs[:done], Qb[:done], cv)
+        self._tock(t[done-1], enH)
+        self.nChunk += 1
+        return(done)
+
+    def _iterate(self,V0,dUin,dUout,hv,Cs,Ct):
+        # Picard iteration of the balanced Cstor||Cbat recurrence
+        #   V[k] = F(V[k-1]) = V[k-1] + d(V[k-1])
+        # as V = V0 + cumsum(d(Vprev)), which converges in a few sweeps
+        # because d() barely depends on V (Cstor << Cbat)
+        bat_ov = self.hvst.bat_ov
+        n = len(dUin)
+        V = np.full(n, V0)
+        for _ in range(60):
+            Vp = np.empty(n)
+            Vp[0] = V0
+            Vp[1:] = V[:-1]
+            if hv:  # boost into Cstor, then balance with Cbat
+                Vh = Vp + (np.sqrt(Cs*Cs*Vp*Vp + 2*Cs*dUin) - Cs*Vp)/Ct
+            else:
+                Vh = Vp
+            Vh = np.minimum(Vh, bat_ov)
+            if dUout is not None:  # sinkU from the combined energy
+                Vh = np.sqrt(np.maximum(Vh*Vh - 2*dUout/Ct, 0))
+                Vh = np.minimum(Vh, bat_ov)
+            Vn = V0 + np.cumsum(Vh - Vp)
+            err = np.max(np.abs(Vn - V))
+            V = Vn
+            if err <= self.tol:
+                return(V)
+        return(None)
+
+    def _scalar(self,t,dT,Pin,Pld,enH,enC):
+        # tick-by-tick replica of harvester.nextQ/converter.nextU/nextState
+        H = self.hvst
+        Cs, Cb = self._Cs, self._Cb
+        Ct = Cs + Cb
+        bat_ov = H.bat_ov
+        closs = self.cnvtr.loss if defined(self.cnvtr) else 0
+        Qs, Qb = self.Qs, self.Qb
+        n = len(t)
+        Qsa, Qba, cva = np.empty(n), np.empty(n), np.empty(n, dtype=bool)
+        tl, dTl, Pin, Pld = t.tolist(), dT.tolist(), Pin.tolist(), Pld.tolist()
+        for i in range(n):
+            s = self.state
+            if self.aliveH:
+                dU = Pin[i] * (1-self._loss(s)) * dTl[i]
+                if s == st['cold'] or s == st['warm']:
+                    Qs = sqrt((Qs*Qs/(2*Cs) + dU)*2*Cs)
+                if s == st['warm'] or s == st['full']:
+                    Qs, Qb = self._balance(Qs, Qb, Cs, Cb, bat_ov)
+            cv = self.aliveC and enC and self.batOK
+            if cv:
+                if isnan(Pld[i]):
+                    self.aliveC = False
+                    cv = False
+                else:
+                    dU = Pld[i] / (1-closs) * dTl[i]
+                    U0 = Qs*Qs/(2*Cs) + Qb*Qb/(2*Cb)
+                    Qs += sqrt((U0 - dU)*2*Ct) - (Qs + Qb)
+                    if s == st['warm'] or s == st['full']:
+                        Qs, Qb = self._balance(Qs, Qb, Cs, Cb, bat_ov)
+            Qsa[i], Qba[i], cva[i] = Qs, Qb, cv
+            self._tock(tl[i], enH, Qs/Cs)
+        self.Qs, self.Qb = Qs, Qb
+        self._record(t, Qsa, Qba, cva)
+        self.nScalar += n
+        return(n)
+
+    def _balance(self,Qs,Qb,Cs,Cb,bat_ov):
+        dQ = (Qs*Cb - Qb*Cs) / (Cs + Cb)
+        Qs, Qb = Qs - dQ, Qb + dQ
+        if Qs / Cs >= bat_ov:
+            Qs, Qb = Cs*bat_ov, Cb*bat_ov
+        return(Qs, Qb)
+
+    def _tock(self,t,enH,V=None):
+        # harvester.nextState, evaluated on the tock after the tick at 't'
+        if V is None:
+            V = self.Qs / self._Cs
+        self.batOK = (V >= self.hvst.bat_ok)
+        prev = self.state
+        self.state = self._eval(V, enH)
+        if prev != self.state:
+            tt = t + self.Tpost if t > 0 else 0
+            self.log.append((tt, prev))
+            self.log.append((tt, self.state))
+
+    def _record(self,t,Qs,Qb,cv):
+        # keep every n-th tock, as a 'scope' on each node would see it
+        sel = slice((-self._recPhase) % self.every, None, self.every)
+        self._recPhase = (self._recPhase + len(t)) % self.every
+        cv = np.broadcast_to(cv, t.shape)[sel]
+        t = t[sel] + self.Tpost
+        Vout = np.where(cv, self.cnvtr._V, 0) if defined(self.cnvtr) else (
+                np.zeros(len(t)))
+        if defined(self.load) and len(t):
+            Iout = self._sample(self.load, self._ld, t) / self.cnvtr._V
+            if isinstance(self.load, hvst.sink):
+                Iout = np.full(len(t), self.load.I)
+            Iout = np.where(cv, Iout, 0)
+        else:
+            Iout = np.zeros(len(t))
+        self._rec.append((t, Qs[sel]/self._Cs, Qb[sel]/self._Cb, Vout, Iout))
+
+    ##########################################################################
+    # results
+
+    def _column(self,i):
+        if not self._rec:
+            return(np.zeros(0))
+        return(np.concatenate([r[i] for r in self._rec]))
+
+    @property
+    def time(self):
+        return(self._column(0))
+
+    @property
+    def Vstor(self):
+        return(self._column(1))
+
+    @property
+    def Vbat(self):
+        return(self._column(2))
+
+    @property
+    def Vout(self):
+        return(self._column(3))
+
+    @property
+    def Iout(self):
+        return(self._column(4))
+
+    @property
+    def Ustored(self):
+        return(self._Cs*self.Vstor**2/2 + self._Cb*self.Vbat**2/2)
+
+    def _commit(self):
+        # leave the component objects as the SimPy run would
+        H = self.hvst
+        H.stor.Q = self.Qs
+        H.bat.Q = self.Qb
+        for tt, state in self.log:
+            H.stateLog.append(tt, state)
+        H.state = self.state
+        H._batOK = self.batOK
+        tLast = self.tLast
+        H.next_Pin = {'time': tLast, 'data': 0}
+        if defined(self.cnvtr):
+            self.cnvtr.next_Pout = {'time': tLast, 'data': 0}
+        for sw in self.switch:
+            flips = np.searchsorted(self._toggles[id(sw)], tLast, side='right')
+            if flips % 2:
+                sw.obj.en = not sw.obj.en
+
+    def _check(self,until):
+        # run the SimPy path on the same objects and compare the traces
+        H = self.hvst
+        probe = [hvst.scope(self.env, self.clock, node) for node in
+                 ((H.stor, 'V'), (H.bat, 'V'))]
+        self.env.run(until=until)
+        tv = self.time
+        self.diff = {}
+        for name, prb in zip(('Vstor', 'Vbat'), probe):
+            ref = np.interp(tv, prb.time, prb.data)
+            self.diff[name] = float(np.max(np.abs(getattr(self, name) - ref)))
+        states = [s for tt, s in self.log[1::2]]
+        ref = H.stateLog['data'][2::2]
+        self.diff['states'] = (states == ref[:len(states)])
+        tv = np.array([tt for tt, s in self.log[1::2]])
+        tr = np.array(H.stateLog['time'][2::2][:len(tv)])
+        n = min(len(tv), len(tr))
+        self.diff['stateTime'] = float(np.max(np.abs(tv[:n] - tr[:n]))) if (
+                n) else 0.0
+        return(self.diff)
+
+##############################################################################
+# A power trace sampled on the tick grid, NaN past its end like Psrc.P
+# 'scale' may be an array, one scale per batch instance
+class trace:
+    def __init__(self,time,data,scale=1):
+        self.time = np.asarray(time, dtype=float)
+        self.data = np.asarray(data, dtype=float)
+        self.scale = scale
+
+    @classmethod
+    def read(cls,fname,Tscale=1,Pscale=1,scale=1,trace=None):
+        # from a Psrc CSV file, or from a trace already read by 'readTrace'
+        hdr, time, data = trace if defined(trace) else hvst.readTrace(fname)
+        return(cls(time*Tscale, data*Pscale, scale))
+
+    def sample(self,t):
+        P = np.interp(t, self.time, self.data)
+        P[t > self.time[-1]] = np.nan
+        if np.ndim(self.scale):
+            return(P[:, None] * self.scale[None, :])
+        return(P * self.scale)
+
+# One power source per batch instance, a stack of traces of any lengths
+# and constant powers: 'sample' gives the (len(t), N) powers, NaN past the
+# end of each instance's own trace
+class stack:
+    def __init__(self,traces,scale=1):
+        # 'trace' objects, (time, data) pairs or constant powers
+        self.traces = [tr if hasattr(tr, 'sample') else
+                       trace(*tr) if isinstance(tr, tuple) else float(tr)
+                       for tr in traces]
+        self.N = len(self.traces)
+        self.scale = np.broadcast_to(np.asarray(scale, dtype=float),
+                                     (self.N,))
+
+    @classmethod
+    def read(cls,fnames,Tscale=1,Pscale=1,scale=1,traces={}):
+        # Psrc CSV files, or the traces of 'readTraces' by file name;
+        # Tscale and Pscale may be one per file
+        N = len(fnames)
+        Tscale = np.broadcast_to(Tscale, (N,))
+        Pscale = np.broadcast_to(Pscale, (N,))
+        read, out = {}, []
+        for i, fname in enumerate(fnames):
+            if fname not in read:  # each file once
+                read[fname] = traces[fname] if fname in traces else (
+                        hvst.readTrace(fname))
+            hdr, time, data = read[fname]
+            out.append(trace(time*Tscale[i], data*Pscale[i]))
+        return(cls(out, scale))
+
+    def sample(self,t):
+        P = np.empty((len(t), self.N))
+        for i, tr in enumerate(self.traces):
+            P[:, i] = tr.sample(t) if hasattr(tr, 'sample') else tr
+        return(P * self.scale[None, :])
+
+# The converter enables at times 't' of an OnOff 'doList', True without one
+# A list of lists gives one doList per instance, (len(t), N) enables
+def enabled(doList,t):
+    if doList and not np.isscalar(doList[0]):
+        return(np.stack([enabled(d, t) for d in doList], axis=1))
+    toggles = np.cumsum(doList) if doList else np.zeros(0)
+    return(np.searchsorted(toggles, t, side='right') % 2 == 0)
+
+##############################################################################
+# N independent harvester + Cstor + Cbat + converter instances
+#
+# The state of every instance (charges, harvester state, batOK, whether the
+# harvester/converter processes are still running) lives in arrays, and one
+# tick of all N instances is a handful of NumPy operations.  Parameters may
+# be scalars or per-instance arrays.
+class batch:
+    def __init__(self,N,period,Cstor,Cbat,Vout=2.5,loss_cold=0.95,
+                 loss_warm=0.25,conv_loss=0.10,chgen=1.73,bat_ok=2.5,
+                 bat_ov=5.5,chunk=1024):
+        self.N = N
+        self.period = period
+        self.Tpost = period/10
+        self.chunk = chunk
+        arr = lambda x: np.broadcast_to(np.asarray(x, dtype=float),
+                                        (N,)).copy()
+        self.Cs, self.Cb = arr(Cstor), arr(Cbat)
+        self.Vout = arr(Vout)
+        self.loss_cold, self.loss_warm = arr(loss_cold), arr(loss_warm)
+        self.conv_loss = arr(conv_loss)
+        self.chgen, self.bat_ok, self.bat_ov = arr(chgen), arr(bat_ok), (
+                arr(bat_ov))
+        # state, as harvester.run and the first nextState leave it
+        self.Qs = np.zeros(N)
+        self.Qb = self.Cb * self.chgen  # precharge the battery
+        self.state = np.full(N, codes[st['off']], dtype=np.int8)
+        self.batOK = np.zeros(N, dtype=bool)
+        self.aliveH = np.ones(N, dtype=bool)
+        self.aliveC = np.ones(N, dtype=bool)
+        # results
+        self.tFirst = np.full((N, len(names)), np.nan)  # first entry/state
+        self.tBatOK = np.full(N, np.nan)  # first time batOK
+        self.onTicks = np.zeros(N, dtype=int)  # ticks with Vout up
+        self.nTicks = np.zeros(N, dtype=int)  # ticks before it stopped
+        self.time = np.zeros(0)
+        self.rec = {}
+
+    @property
+    def Vstor(self):
+        return(self.Qs / self.Cs)
+
+    @property
+    def Vbat(self):
+        return(self.Qb / self.Cb)
+
+    @property
+    def Ustored(self):
+        return(self.Qs**2/(2*self.Cs) + self.Qb**2/(2*self.Cb))
+
+    @property
+    def uptime(self):
+        # as TEG_scenario's: the fraction of the run with Vout up, the
+        # converter enabled and batOK, until the harvester and converter
+        # have both stopped
+        return(self.onTicks / np.maximum(self.nTicks, 1))
+
+    def _balance(self,sel):
+        # harvester.balance on the instances in 'sel'
+        Cs, Cb = self.Cs, self.Cb
+        dQ = (self.Qs*Cb - self.Qb*Cs) / (Cs + Cb)
+        dQ[~sel] = 0
+        self.Qs -= dQ
+        self.Qb += dQ
+        ov = sel & (self.Qs/Cs >= self.bat_ov)
+        self.Qs[ov] = (Cs*self.bat_ov)[ov]
+        self.Qb[ov] = (Cb*self.bat_ov)[ov]
+
+    def step(self,dT,Pin,Pld,enC=True):
+        # one tick: harvester.nextQ then converter.nextU, for all instances
+        s = self.state
+        cold, warm, full = (s == codes[st['cold']], s == codes[st['warm']],
+                            s == codes[st['full']])
+        self.aliveH &= ~np.isnan(Pin)
+        loss = np.where(cold, self.loss_cold,
+                        np.where(warm | full, self.loss_warm, 1))
+        dU = np.where(self.aliveH, Pin, 0) * (1-loss) * dT
+        boost = self.aliveH & (cold | warm)
+        Us = self.Qs**2/(2*self.Cs) + dU
+        self.Qs = np.where(boost, np.sqrt(np.maximum(Us, 0)*2*self.Cs),
+                           self.Qs)
+        self._balance(self.aliveH & (warm | full))
+        cv = self.aliveC & enC & self.batOK
+        self.aliveC &= ~(cv & np.isnan(Pld))
+        cv &= self.aliveC
+        if cv.any():
+            Ct = self.Cs + self.Cb
+            dU = np.where(cv, Pld, 0) / (1-self.conv_loss) * dT
+            U0 = self.Ustored
+            Q1 = np.sqrt(np.maximum(U0 - dU, 0)*2*Ct)
+            self.Qs += np.where(cv, Q1 - (self.Qs + self.Qb), 0)
+            self._balance(cv & (warm | full))
+        live = self.aliveH | self.aliveC
+        self.onTicks += live & enC & self.batOK
+        self.nTicks += live
+
+    def tock(self,t,enH=True):
+        # harvester.nextState for all instances
+        V = self.Vstor
+        self.batOK = V >= self.bat_ok
+        prev = self.state
+        self.state = np.where(~np.asarray(enH, dtype=bool),
+                              codes[st['off']],
+                     np.where(V < self.chgen, codes[st['cold']],
+                     np.where(V < self.bat_ov*0.999, codes[st['warm']],
+                              codes[st['full']]))).astype(np.int8)
+        new = (self.state != prev) & np.isnan(
+                self.tFirst[np.arange(self.N), self.state])
+        self.tFirst[new, self.state[new]] = t
+        self.tBatOK[self.batOK & np.isnan(self.tBatOK)] = t
+
+    def run(self,until,Pin,Pld=0.0,doList=None,every=100,
+            record=('Vstor', 'Vbat')):
+        # Pin/Pld: 'trace' or 'stack' objects or constant powers; 'doList'
+        # switches the converters on and off like OnOff, one list for all
+        # instances or one per instance; every n-th tock is recorded
+        per = self.period
+        K = int(ceil(until / per - 1e-9))
+        times, rec = [], {name: [] for name in record}
+        self.tock(0)
+        for k0 in range(0, K, self.chunk):
+            t = np.arange(k0, min(k0 + self.chunk, K)) * per
+            Pi, Pl = self._sample(Pin, t), self._sample(Pld, t)
+            enC = enabled(doList, t)
+            for i in range(len(t)):
+                self.step(per if k0 + i else 0, Pi[i], Pl[i], enC[i])
+                tt = t[i] + self.Tpost if k0 + i else 0
+                self.tock(tt)
+                if (k0 + i) % every == 0:
+                    times.append(tt)
+                    for name in record:
+                        rec[name].append(getattr(self, name).copy())
+        self.time = np.array(times)
+        self.rec = {name: np.array(rec[name]) for name in record}
+        return(self)
+
+    def _sample(self,src,t):
+        # (len(t), N) powers from a 'trace' or a constant
+        if not hasattr(src, 'sample'):
+            return(np.full((len(t), self.N), float(src)))
+        P = src.sample(t)
+        return(np.broadcast_to(P if P.ndim == 2 else P[:, None],
+                               (len(t), self.N)))
+
+    def bands(self,name,pct=(5, 50, 95)):
+        # percentiles across the instances of a recorded node, per tock
+        return(np.percentile(self.rec[name], pct, axis=1))
+
+    def fraction(self,t,within):
+        # the fraction of instances whose time 't' is <= 'within'
+        return(float(np.mean(t <= within)))
+
+##############################################################################
+# A fleet of N nodes under one Harvest3 'clock', as one SimPy process
+#
+# Each node is a harvester + Cstor + Cbat + converter, kept in a 'batch':
+# the fleet asks for the clock once, steps every node on each tick and
+# updates every state machine on each tock, so N nodes cost one process
+# instead of a set per node.  The inputs of each chunk of ticks are sampled
+# ahead, so the traces are not read tick by tick.  It lets the clock go
+# when the harvesters and converters of all nodes have stopped
+#   Pin/Pld: 'stack' of per-node sources, a 'trace' or a constant power
+#   doList:  one OnOff list for all nodes, or one per node
+class fleet:
+    def __init__(self,env,clock,N,Pin,Pld=0.0,doList=None,every=100,
+                 record=('Vstor', 'Vbat'),chunk=1024,unit=1,**params):
+        self.env = env
+        self.clock = clock
+        self.name = 'Fleet'+str(unit)
+        self.batch = batch(N, clock.period, chunk=chunk, **params)
+        self.N = N
+        self.Pin = Pin
+        self.Pld = Pld
+        self.doList = doList
+        self.every = every
+        self.record = record
+        self.running = False
+        self._times = []
+        self._rec = {name: [] for name in record}
+        self.env.process(self.run())
+
+    def run(self):
+        b, env, per = self.batch, self.env, self.clock.period
+        self.clock.start(self)
+        self.running = True
+        # t=0, as harvester.run and converter.run start
+        b.tock(env.now)
+        Pi, Pl, enC = self._inputs(np.array([env.now]))
+        b.step(0, Pi[0], Pl[0], enC[0])
+        k, i, last = 0, len(Pi), env.now  # the first tick samples anew
+        while b.aliveH.any() or b.aliveC.any():
+            yield self.clock.tock
+            b.tock(env.now)
+            if k % self.every == 0:
+                self._times.append(env.now)
+                for name in self.record:
+                    self._rec[name].append(getattr(b, name).copy())
+            k += 1
+            yield self.clock.tick
+            if i == len(Pi):  # the next chunk of ticks
+                Pi, Pl, enC = self._inputs(env.now +
+                                           per*np.arange(b.chunk))
+                i = 0
+            b.step(env.now - last, Pi[i], Pl[i], enC[i])
+            i, last = i+1, env.now
+        self.clock.stop(self)
+        self.running = False
+
+    def _inputs(self,t):
+        enC = enabled(self.doList, t)
+        if enC.ndim == 1:
+            enC = np.broadcast_to(enC[:, None], (len(t), self.N))
+        return(self.batch._sample(self.Pin, t),
+               self.batch._sample(self.Pld, t), enC)
+
+    @property
+    def time(self):
+        return(np.array(self._times))
+
+    def rec(self,name):
+        # (tocks, N) values of a recorded node
+        return(np.array(self._rec[name]))
+
+    def bands(self,name,pct=(5, 50, 95)):
+        # percentiles across the nodes of a recorded node, per tock
+        return(np.percentile(self.rec(name), pct, axis=1))
+
+    def stats(self,within=None,pct=(5, 50, 95)):
+        # fleet figures: the spread of uptime and of the time to batOK
+        b = self.batch
+        tOK = b.tBatOK
+        reached = tOK[~np.isnan(tOK)]
+        out = {'N': self.N, 'time': self.env.now,
+               'batOK_reached': float(np.mean(~np.isnan(tOK))),
+               'uptime_mean': float(np.mean(b.uptime))}
+        for p in pct:
+            out['uptime_p%g' % p] = float(np.percentile(b.uptime, p))
+        for p in pct:
+            out['tBatOK_p%g' % p] = float(np.percentile(reached, p)) if len(
+                    reached) else None
+        if defined(within):
+            out['batOK_within'] = b.fraction(tOK, within)
+        return(out)
+
+    def table(self):
+        # one row per node
+        b = self.batch
+        return([{'node': i, 'uptime': float(b.uptime[i]),
+                 'tBatOK': None if isnan(b.tBatOK[i]) else float(b.tBatOK[i]),
+                 'tWarm': None if isnan(b.tFirst[i, codes[st['warm']]]) else
+                          float(b.tFirst[i, codes[st['warm']]]),
+                 'Vbat': float(b.Vbat[i]), 'state': names[b.state[i]]}
+                for i in range(self.N)])
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of a Harvest3 simulation
+
+Counts calls and wall time per component method and per SimPy process, and
+the events scheduled per clock tick.  Nothing is patched until 'enable', and
+'disable' puts every original back, so a run without a profiler pays nothing
+
+    prof = HarvestProf.profiler(env, clk)
+    prof.enable()       # before the components are built, to see processes
+    ...build the components...
+    env.run(until=50)   # prints the table when the run returns
+    prof.disable()
+"""
+
+import sys
+import csv
+import json
+import inspect
+from time import perf_counter
+import numpy as np
+from simpy.events import NORMAL
+import Harvest3 as hvst
+
+# One line of the table: calls, inclusive and own seconds
+class stat:
+    __slots__ = ('name', 'calls', 'total', 'own')
+
+    def __init__(self,name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+
+##############################################################################
+# Patches the classes of 'modules' and the environment 'env'
+#   clock:  bins the scheduled events per tick, when given
+#   report: print the table at the end of each env.run
+#   out:    also save it there, as JSON (or CSV by extension)
+class profiler:
+    def __init__(self,env,clock=None,modules=(hvst,),report=True,out=None):
+        self.env = env
+        self.clock = clock
+        self.modules = modules
+        self.report = report
+        self.out = out
+        self.stats = {}
+        self.scheduled = 0
+        self.processed = 0
+        self.perTick = []  # events scheduled in each clock period
+        self.wall = 0.0
+        self._stack = [0.0]  # seconds spent in callees, per open frame
+        self._saved = []  # (owner, name, original) to put back
+        self.enabled = False
+
+    def stat(self,name):
+        s = self.stats.get(name)
+        if s is None:
+            s = self.stats[name] = stat(name)
+        return(s)
+
+    def enable(self):
+        if self.enabled:
+            return(self)
+        for mod in self.modules:
+            for cname, cls in inspect.getmembers(mod, inspect.isclass):
+                if cls.__module__ == mod.__name__:
+                    self._patchClass(cls)
+        env = self.env
+        for name, wrap in (('process', self._process),
+                           ('schedule', self._schedule),
+                           ('step', self._step), ('run', self._run)):
+            self._patch(env, name, wrap(getattr(env, name)))
+        self.enabled = True
+        return(self)
+
+    def disable(self):
+        for owner, name, orig in reversed(self._saved):
+            if orig is None:  # was a bound method of the instance's class
+                delattr(owner, name)
+            else:
+                setattr(owner, name, orig)
+        self._saved = []
+        self.enabled = False
+        return(self)
+
+    def __enter__(self):
+        return(self.enable())
+
+    def __exit__(self,*exc):
+        self.disable()
+
+    def _patch(self,owner,name,value):
+        orig = vars(owner).get(name) if isinstance(owner, type) else (
+                owner.__dict__.get(name))
+        self._saved.append((owner, name, orig))
+        setattr(owner, name, value)
+
+    def _patchClass(self,cls):
+        for name, attr in list(vars(cls).items()):
+            label = '%s.%s' % (cls.__name__, name)
+            if isinstance(attr, property) and attr.fget:
+                self._patch(cls, name, property(
+                        self._timed(attr.fget, label), attr.fset,
+                        attr.fdel, attr.__doc__))
+            elif inspect.isfunction(attr) and not (
+                    name.startswith('__') or
+                    inspect.isgeneratorfunction(attr)):
+                self._patch(cls, name, self._timed(attr, label))
+            # generator methods are timed per resume, as processes
+
+    def _timed(self,f,label):
+        s = self.stat(label)
+        stack = self._stack
+        def timed(*args, **kwargs):
+            stack.append(0.0)
+            t0 = perf_counter()
+            try:
+                return(f(*args, **kwargs))
+            finally:
+                dt = perf_counter() - t0
+                inner = stack.pop()
+                stack[-1] += dt
+                s.calls += 1
+                s.total += dt
+                s.own += dt - inner
+        timed.__wrapped__ = f
+        return(timed)
+
+    def _proxy(self,gen,s):
+        # run 'gen', timing each resume as one call of stat 's'
+        stack = self._stack
+        value, exc = None, None
+        while True:
+            stack.append(0.0)
+            t0 = perf_counter()
+            try:
+                event = gen.throw(exc) if exc else gen.send(value)
+            except StopIteration as e:
+                return(e.value)
+            finally:
+                dt = perf_counter() - t0
+                inner = stack.pop()
+                stack[-1] += dt
+                s.calls += 1
+                s.total += dt
+                s.own += dt - inner
+            try:
+                value, exc = (yield event), None
+            except BaseException as e:  # Interrupt, or GeneratorExit
+                value, exc = None, e
+
+    def _process(self,process):
+        def wrapped(gen):
+            name = 'process ' + getattr(gen, '__qualname__', repr(gen))
+            return(process(self._proxy(gen, self.stat(name))))
+        return(wrapped)
+
+    def _schedule(self,schedule):
+        env = self.env
+        def wrapped(event, priority=NORMAL, delay=0):
+            self.scheduled += 1
+            if self.clock is not None:
+                i = int(env.now / self.clock.period)
+                if i >= len(self.perTick):
+                    self.perTick.extend([0] * (i + 1 - len(self.perTick)))
+                self.perTick[i] += 1
+            schedule(event, priority, delay)
+        return(wrapped)
+
+    def _step(self,step):
+        def wrapped():
+            self.processed += 1
+            step()
+        return(wrapped)
+
+    def _run(self,run):
+        def wrapped(until=None):
+            t0 = perf_counter()
+            try:
+                return(run(until))
+            finally:
+                self.wall += perf_counter() - t0
+                if self.report:
+                    self.print()
+                if self.out:
+                    self.save(self.out)
+        return(wrapped)
+
+    ##########################################################################
+    # results
+
+    def summary(self):
+        ticks = np.array(self.perTick, dtype=float)
+        return({'sim_time': self.env.now,
+                'wall': self.wall,
+                'events_scheduled': self.scheduled,
+                'events_processed': self.processed,
+                'ticks': len(ticks),
+                'events_per_tick_mean': float(ticks.mean()) if len(
+                        ticks) else None,
+                'events_per_tick_max': int(ticks.max()) if len(
+                        ticks) else None})
+
+    def table(self):
+        # one row per method or process, the most own time first
+        rows = [{'name': s.name, 'calls': s.calls, 'total': s.total,
+                 'own': s.own, 'per_call_us': 1e6 * s.total / s.calls}
+                for s in self.stats.values() if s.calls]
+        return(sorted(rows, key=lambda r: -r['own']))
+
+    def print(self,file=None):
+        file = file or sys.stdout
+        print('%-32s %10s %10s %10s %10s' % ('component', 'calls', 'total s',
+              'own s', 'us/call'), file=file)
+        for r in self.table():
+            print('%-32s %10d %10.3f %10.3f %10.2f' % (r['name'], r['calls'],
+                  r['total'], r['own'], r['per_call_us']), file=file)
+        for k, v in self.summary().items():
+            print('%-32s %s' % (k, v), file=file)
+
+    def save(self,fname):
+        if fname.endswith('.csv'):
+            with open(fname, 'w', newline='') as f:
+                out = csv.DictWriter(f, ['name', 'calls', 'total', 'own',
+                                         'per_call_us'])
+                out.writeheader()
+                out.writerows(self.table())
+            return
+        with open(fname, 'w') as f:
+            json.dump({'summary': self.summary(), 'table': self.table(),
+                       'per_tick': self.perTick}, f, indent=1)
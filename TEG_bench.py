@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the Harvest3 simulation
+
+    python TEG_bench.py suite --out bench.json    all scenarios, saved
+    python TEG_bench.py suite --only dsply load   some of them
+    python TEG_bench.py compare old.json new.json
+    python TEG_bench.py clock     events/sec of the clock, before and after
+
+Each suite scenario runs in its own process, so that its peak memory is its
+own.  Building the scenario (and reading its traces) is outside the timed
+region, and nothing is plotted.
+"""
+
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import resource
+import subprocess
+import cProfile
+import pstats
+import numpy as np
+import simpy
+import Harvest3 as hvst
+import TEG_scenario as scn
+
+# A SimPy environment that counts the events it processes
+class countingEnv(simpy.Environment):
+    def __init__(self,initial_time=0):
+        super().__init__(initial_time)
+        self.events = 0
+    
+    def step(self):
+        self.events += 1
+        super().step()
+
+# The clock as it was, with a new process per period for 'tick' and 'tock'
+class legacyClock(hvst.clock):
+    def __init__(self,env,period,resume=None,verbose=True):
+        if resume is not None:
+            raise ValueError('legacyClock: cannot resume a checkpoint')
+        self.env = env
+        self.verbose = verbose
+        self.period = period
+        self.Tpost = period/10
+        self.tick = None
+        self.tock = None
+        self.req = {}
+        self.running = True
+        self.env.process(self.runTick(self.period))
+        self.env.process(self.runTock(self.period))
+    
+    def runTick(self,period):
+        if self.verbose:
+            print('Clock start: @ %f' % self.env.now)
+        while len(self.req) == 0:
+            self.tick = self.env.process(self.step(period))
+            yield self.tick
+        while len(self.req) > 0:
+            self.tick = self.env.process(self.step(period))
+            yield self.tick
+        if self.verbose:
+            print('Clock stop: @ %f' % self.env.now)
+        self.running = False
+        self.tick = None
+    
+    def runTock(self,period):
+        self.tock = self.env.timeout(self.Tpost)
+        yield self.tock
+        while self.running:
+            self.tock = self.env.process(self.step(period))
+            yield self.tock
+        if self.verbose:
+            print('Tock stop: @ %f' % self.env.now)
+        self.tock = None
+    
+    def step(self,delT):
+        yield self.env.timeout(delT)
+
+# Build a scenario with a counting environment and the given clock class
+def build(cfg={},traces={},clk=hvst.clock):
+    Environment, clock = simpy.Environment, hvst.clock
+    simpy.Environment, hvst.clock = countingEnv, clk
+    try:
+        return(scn.scenario(cfg, traces))
+    finally:
+        simpy.Environment, hvst.clock = Environment, clock
+
+# Time one run; plotting is never part of it
+def timed(sc):
+    t0 = time.perf_counter()
+    sc.run(quiet=True)
+    wall = time.perf_counter() - t0
+    return({'wall': wall,
+            'sim_time': sc.env.now,
+            'events': sc.env.events,
+            'events_per_s': sc.env.events / wall,
+            'sim_per_wall': sc.env.now / wall})
+
+# events/sec of the TEG_model3 scenario with the legacy and the current clock
+def clockBench(cfg={},repeat=3):
+    traces = scn.readTraces(cfg)
+    rows = []
+    for name, clk in (('before', legacyClock), ('after', hvst.clock)):
+        best = min((timed(build(cfg, traces, clk)) for i in range(repeat)),
+                   key=lambda r: r['wall'])
+        rows.append(dict(best, clock=name))
+    return(rows)
+
+##############################################################################
+# The suite: representative scenarios as config overrides of TEG_scenario,
+# plus extras that 'prepare' applies to the built scenario
+suite = {
+    'dsply': {},  # TEG_model3 as it is, the display load
+    'load': {'load': 'load'},  # sink load switched by OnOff
+    'long': {'load': 'load', 'stop_time': 400, 'repeat': 10},  # long trace
+    'probes': {'scopes': 100},  # many probes, one scope process each
+    'stress': {'clock_period': 1e-4, 'stop_time': 5},  # small clock period
+}
+
+def prepare(name):
+    # the scenario of suite entry 'name', built and ready to run
+    cfg = dict(suite[name])
+    repeat = cfg.pop('repeat', 1)
+    scopes = cfg.pop('scopes', 0)
+    traces = scn.readTraces(cfg)
+    if repeat > 1:  # the TEG trace end to end 'repeat' times
+        fname = dict(scn.defaults, **cfg)['teg_file']
+        hdr, t, P = traces[fname]
+        span = t[-1] + (t[1] - t[0])
+        t = np.concatenate([t + i * span for i in range(repeat)])
+        traces[fname] = (hdr, t, np.tile(P, repeat))
+        cfg['doList'] = list(scn.defaults['doList']) * repeat
+    sc = build(cfg, traces)
+    nodes = [(sc.Cstor, 'V'), (sc.Cbat, 'V'), (sc.harvester, 'dU'),
+             (sc.buckOut, 'I'), (sc.teg, 'P')]
+    sc.scopes = [hvst.scope(sc.env, sc.clk, nodes[i % len(nodes)])
+                 for i in range(scopes)]
+    return(sc)
+
+def component(code):
+    # the Harvest3 class of a profiled function, else its package
+    fname = code[0]
+    if fname == '~':  # C functions: list.append, getattr, ...
+        return('builtins')
+    if os.path.abspath(fname) == os.path.abspath(hvst.__file__):
+        return(_lines.get(code[1], 'Harvest3'))
+    for pkg in ('simpy', 'numpy'):
+        if os.sep + pkg + os.sep in fname:
+            return(pkg)
+    return('other')
+
+def _classLines():
+    # first line of every Harvest3 method -> its class name
+    lines = {}
+    for cname, cls in inspect.getmembers(hvst, inspect.isclass):
+        if cls.__module__ != hvst.__name__:
+            continue
+        for attr in vars(cls).values():
+            for f in (attr, getattr(attr, 'fget', None),
+                      getattr(attr, 'fset', None)):
+                if inspect.isfunction(f):
+                    lines[f.__code__.co_firstlineno] = cname
+    return(lines)
+
+_lines = _classLines()
+
+def profile(sc):
+    # seconds of own time per component, from one profiled run
+    prof = cProfile.Profile()
+    prof.runcall(sc.run, quiet=True)
+    parts = {}
+    for code, stat in pstats.Stats(prof).stats.items():
+        name = component(code)
+        parts[name] = parts.get(name, 0.0) + stat[2]  # tottime
+    return(dict(sorted(parts.items(), key=lambda p: -p[1])))
+
+def one(name,prof=True):
+    # benchmark suite entry 'name' in this process
+    row = dict(timed(prepare(name)), name=name)
+    row['peak_rss_mb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+    if prof:
+        row['components'] = profile(prepare(name))
+    return(row)
+
+def revision():
+    try:
+        return(subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(
+                                      __file__))).stdout.strip() or None)
+    except OSError:
+        return(None)
+
+def runSuite(names=None,prof=True):
+    # every entry in a fresh process; returns the JSON-ready results
+    rows = []
+    for name in names or suite:
+        cmd = [sys.executable, os.path.abspath(__file__), 'one', name]
+        if not prof:
+            cmd.append('--no-profile')
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        rows.append(json.loads(out.stdout.splitlines()[-1]))
+    return({'revision': revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'simpy': simpy.__version__,
+            'numpy': np.__version__,
+            'results': rows})
+
+def report(res):
+    print('%-8s %8s %9s %9s %9s %8s  %s' % ('scenario', 'sim s', 'wall s',
+          'sim s/s', 'events', 'peak MB', 'top components (s)'))
+    for r in res['results']:
+        top = ', '.join('%s %.2f' % p for p in list(
+                r.get('components', {}).items())[:4])
+        print('%-8s %8.1f %9.3f %9.2f %9d %8.1f  %s' % (r['name'],
+              r['sim_time'], r['wall'], r['sim_per_wall'], r['events'],
+              r['peak_rss_mb'], top))
+
+def compare(old,new):
+    # speed-up of 'new' over 'old', per scenario in both
+    prev = {r['name']: r for r in old['results']}
+    print('%-8s %10s %10s %8s' % ('scenario', 'old s/s', 'new s/s', 'ratio'))
+    for r in new['results']:
+        if r['name'] in prev:
+            a, b = prev[r['name']]['sim_per_wall'], r['sim_per_wall']
+            print('%-8s %10.2f %10.2f %8.2f' % (r['name'], a, b, b / a))
+
+##############################################################################
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Harvest3 benchmarks')
+    sub = ap.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('suite', help='run the benchmark suite')
+    p.add_argument('--only', nargs='+', choices=list(suite), default=None)
+    p.add_argument('--out', default=None, help='JSON file for the results')
+    p.add_argument('--no-profile', action='store_true',
+                   help='skip the per-component profile runs')
+    p = sub.add_parser('one', help='one suite scenario, JSON to stdout')
+    p.add_argument('name', choices=list(suite))
+    p.add_argument('--no-profile', action='store_true')
+    p = sub.add_parser('compare', help='compare two saved suite results')
+    p.add_argument('old')
+    p.add_argument('new')
+    p = sub.add_parser('clock', help='events/sec of the old and new clock')
+    p.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args(argv)
+    if args.bench == 'one':
+        print(json.dumps(one(args.name, not args.no_profile)))
+    elif args.bench == 'suite':
+        res = runSuite(args.only, not args.no_profile)
+        report(res)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(res, f, indent=1)
+        return(res)
+    elif args.bench == 'compare':
+        with open(args.old) as f, open(args.new) as g:
+            compare(json.load(f), json.load(g))
+    else:
+        rows = clockBench(repeat=args.repeat)
+        print('%-8s %10s %10s %12s %10s' % ('clock', 'wall s', 'events',
+                                             'events/s', 'sim s/s'))
+        for r in rows:
+            print('%-8s %10.3f %10d %12.0f %10.2f' % (r['clock'], r['wall'],
+                  r['events'], r['events_per_s'], r['sim_per_wall']))
+        return(rows)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
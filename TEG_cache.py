@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+A content-addressed cache of TEG_model3 scenario results
+
+The key hashes the full scenario config, the contents of its input traces
+and the model source, so an edited CSV or model file never hits a stale
+entry; traces passed in memory are hashed as they are, not their files.
+Entries are .npz files with the probe traces, the harvester state log and
+the metrics; the least recently used ones are deleted once the folder
+outgrows 'size'
+
+    cache = TEG_cache.cache()
+    res = cache.run(cfg)       # runs the scenario only on a miss
+    res.metrics, res.stateLog, res.prb['Vbat'].time
+"""
+
+import os
+import copy
+import json
+import hashlib
+import numpy as np
+import Harvest3 as hvst
+import TEG_scenario as scn
+
+# config keys that do not change the results
+ignore = ('cache', 'table', 'spill', 'profile', 'ledger')
+# config keys that name input files, hashed by content
+files = ('teg_file', 'dsply_file')
+# model sources, hashed into every key
+sources = (hvst.__file__, scn.__file__)
+
+_hashes = {}  # (path, size, mtime) -> SHA-1, for files hashed before
+_traceHashes = {}  # file SHA-1 -> 'traceHash' of the trace read from it
+
+def fileHash(fname):
+    stat = os.stat(fname)
+    k = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if k not in _hashes:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _hashes[k] = h.hexdigest()
+    return(_hashes[k])
+
+def traceHash(trace):
+    # the SHA-1 of the columns of a trace, (hdr, time, data)
+    hdr, time, data = trace
+    h = hashlib.sha1()
+    for a in (time, data):
+        h.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    return(h.hexdigest())
+
+def inputHash(fname,traces={}):
+    # the hash of input 'fname' as the scenario reads it: from 'traces' if
+    # there, else from the file
+    if fname in traces:
+        return(traceHash(traces[fname]))
+    k = fileHash(fname)
+    if k not in _traceHashes:
+        _traceHashes[k] = traceHash(hvst.readTrace(fname))
+    return(_traceHashes[k])
+
+def _number(v):
+    # 10 and 10.0 are the same setting
+    if isinstance(v, (list, tuple)):
+        return([_number(x) for x in v])
+    if isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+        return(float(v))
+    return(v)
+
+# The cache key of a scenario config, run with input 'traces'
+def key(cfg={},traces={}):
+    cfg = dict(scn.defaults, **cfg)
+    for name in ignore:
+        cfg.pop(name, None)
+    for name in files:
+        if cfg['load'] == 'dsply' or name != 'dsply_file':
+            cfg[name] = inputHash(cfg[name], traces)
+        else:
+            cfg.pop(name)  # not read by this load
+    cfg = {name: _number(v) for name, v in cfg.items()}
+    cfg['model'] = [fileHash(f) for f in sources]
+    text = json.dumps(cfg, sort_keys=True, default=repr)
+    return(hashlib.sha1(text.encode()).hexdigest())
+
+##############################################################################
+# A probe trace read back from a cache entry
+stored = hvst.Trace
+
+# The results of one scenario run, from the simulation or from the cache
+class result:
+    def __init__(self,cfg,metrics,stateLog,prb,hit=False):
+        self.cfg = cfg
+        self.metrics = metrics
+        self.stateLog = stateLog
+        self.prb = prb
+        self.hit = hit
+
+    @classmethod
+    def fromScenario(cls,sc):
+        # the probes as views, not copies: spilled ones stay memory-mapped
+        prb = {name: stored(sc.prb[name].time, sc.prb[name].data)
+               for name in sc.prb.names}
+        return(cls(sc.cfg, sc.metrics(), copy.deepcopy(sc.harvester.stateLog),
+                   prb))
+
+##############################################################################
+# The cache folder, at most 'size' bytes of entries
+class cache:
+    def __init__(self,folder='__resultcache__',size=2**30):
+        self.folder = folder
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self,k):
+        return(os.path.join(self.folder, k + '.npz'))
+
+    def get(self,cfg,traces={}):
+        # the stored result of 'cfg', or None
+        fname = self.path(key(cfg, traces))
+        try:
+            with np.load(fname) as f:
+                meta = json.loads(str(f['meta']))
+                log = hvst.stateLog.fromRuns(f['log_start'], f['log_code'],
+                                             meta['log_end'])
+                prb = {name: stored(f['time_' + name], f['data_' + name])
+                       for name in meta['probes']}
+            os.utime(fname)  # recently used
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return(None)
+        self.hits += 1
+        return(result(meta['cfg'], meta['metrics'], log, prb, hit=True))
+
+    def put(self,cfg,res,traces={}):
+        # store 'res', the result of 'cfg', then evict down to 'size'
+        fname = self.path(key(cfg, traces))
+        log = res.stateLog
+        meta = {'cfg': res.cfg, 'metrics': res.metrics,
+                'probes': list(res.prb), 'log_end': log.end}
+        arrays = {'meta': np.array(json.dumps(meta, default=repr)),
+                  'log_start': np.array(log.start),
+                  'log_code': np.array(log.code)}
+        for name, p in res.prb.items():
+            arrays['time_' + name] = p.time
+            arrays['data_' + name] = p.data
+        tmp = '%s.%d.tmp' % (fname, os.getpid())  # workers share the folder
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, fname)
+        self.evict()
+
+    def run(self,cfg={},traces={}):
+        # the result of 'cfg', simulated only when not in the cache
+        res = self.get(cfg, traces)
+        if res is None:
+            res = result.fromScenario(scn.scenario(cfg, traces).run(
+                    quiet=True))
+            self.put(cfg, res, traces)
+        return(res)
+
+    def entries(self):
+        # (last use, bytes, path) of every entry, oldest first
+        out = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except OSError:  # evicted by another process
+                    continue
+                out.append((stat.st_mtime, stat.st_size,
+                            os.path.join(self.folder, name)))
+        return(sorted(out))
+
+    def evict(self,size=None):
+        size = self.size if size is None else size
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, nbytes, fname in entries:
+            if total <= size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= nbytes
+
+    def clear(self):
+        self.evict(0)
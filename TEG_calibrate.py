@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Fit the TEG_model3 loss parameters to measured voltage traces
+
+The measured CSV has a time column and any of Vstor, Vbat and Vout, with
+the names in its header.  The fit is a pattern search: each round runs the
+scenario at a step up and down of every free parameter, all in a process
+pool, moves to the best and halves the steps when none is better
+
+    python TEG_calibrate.py measured.csv --fit loss_cold loss_warm conv_loss
+    python TEG_calibrate.py measured.csv --fit loss_warm Bat --set load=load
+"""
+
+import os
+import csv
+import sys
+import json
+import argparse
+import numpy as np
+import Harvest3 as hvst
+import TEG_scenario as scn
+import TEG_cache
+
+# the parameters a fit may free: (low, high, first step, scale); 'log'
+# parameters step by factors, the others by fractions of their range
+params = {
+    'loss_cold': (0.0, 0.999, 0.05, 'lin'),
+    'loss_warm': (0.0, 0.999, 0.05, 'lin'),
+    'conv_loss': (0.0, 0.999, 0.05, 'lin'),
+    'Stor': (1e-7, 1e-3, 0.25, 'log'),
+    'Bat': (1e-4, 1.0, 0.25, 'log'),
+}
+
+# nodes that can be compared, scenario probes by name, and the weights of
+# their errors: Vout only steps between 0 and Vout, so it says when the
+# converter ran, but a step a little early or late costs a lot
+nodes = {'Vstor': 1.0, 'Vbat': 1.0, 'Vout': 0.1}
+
+# Measured traces from a CSV file: {node: Trace}
+def readMeasured(fname):
+    with open(fname, newline='', encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f) if row]
+    hdr = [h.strip() for h in rows[0]]
+    data = np.array(rows[1:], dtype=float)
+    out = {}
+    for i, name in enumerate(hdr[1:], 1):
+        if name in nodes:
+            out[name] = hvst.Trace(data[:, 0], data[:, i], name)
+    if not out:
+        raise ValueError('%s: no column named %s' % (fname, ', '.join(
+                nodes)))
+    return(out)
+
+# Weighted sum over the nodes of the RMS error of 'prb' at the measured
+# times, relative to each node's measured RMS
+def error(prb,measured,weights=nodes):
+    err = 0.0
+    for name, meas in measured.items():
+        sim = prb[name]
+        sim = sim if isinstance(sim, hvst.Trace) else hvst.Trace(
+                sim.time, sim.data, name)
+        d = sim.at(meas.time) - meas.data
+        d = d[~np.isnan(d)]
+        if not len(d):
+            return(np.inf)
+        scale = np.sqrt(np.mean(meas.data**2)) or 1.0
+        rms = np.sqrt(np.mean(d**2))
+        err += weights.get(name, nodes[name]) * rms / scale
+    return(float(err))
+
+##############################################################################
+# in the workers: the measured traces, input traces, cache and weights, as
+# TEG_scenario.worker
+def _evaluate(cfg):
+    # the error of 'cfg', inf when the model fails, e.g. a cap drained below
+    # empty
+    w = scn.worker
+    try:
+        if w['cache'] is not None:
+            prb = w['cache'].run(cfg, w['traces']).prb
+        else:
+            prb = scn.scenario(cfg, w['traces']).run(quiet=True).prb
+    except scn.failures:
+        return(np.inf)
+    return(error(prb, w['measured'], w['weights']))
+
+##############################################################################
+# A fit of the parameters 'free' in the scenario 'cfg' to 'measured'
+#   x:     the best parameters so far, {name: value}
+#   err:   their error
+#   evals: every candidate run, {values: error}, none run twice
+class calibration:
+    def __init__(self,measured,free=('loss_cold', 'loss_warm', 'conv_loss'),
+                 cfg={},jobs=None,cache=None,weights=nodes,traces=None):
+        self.measured = measured
+        self.free = list(free)
+        for name in self.free:
+            if name not in params:
+                raise ValueError('cannot fit %s' % name)
+        tEnd = max(m.time[-1] for m in measured.values())
+        self.cfg = cfg = dict(scn.defaults, **dict({'stop_time': tEnd},
+                                                    **cfg))
+        if isinstance(cache, str):
+            cache = TEG_cache.cache(cache)
+        self.cache = cache
+        self.weights = weights
+        self.traces = scn.readTraces(cfg) if traces is None else traces
+        self.jobs = jobs or os.cpu_count()
+        self.x = {name: cfg[name] for name in self.free}
+        self.step = {name: params[name][2] for name in self.free}
+        self.err = None
+        self.evals = {}
+        self.state = {'measured': measured, 'traces': self.traces,
+                      'cache': cache, 'weights': weights}
+        self.history = []  # (x, err) after each round
+
+    def _key(self,x):
+        return(tuple(round(float(x[name]), 12) for name in self.free))
+
+    def _moved(self,name,sign):
+        # x with one parameter stepped, within its bounds
+        lo, hi, first, scale = params[name]
+        v = self.x[name]
+        if scale == 'log':
+            v = v * (1 + self.step[name]) ** sign
+        else:
+            v = v + sign * self.step[name] * (hi - lo)
+        return(dict(self.x, **{name: min(max(v, lo), hi)}))
+
+    def evaluate(self,xs,pool=None):
+        # the errors of candidates 'xs', running only the new ones
+        new = []
+        for x in xs:
+            k = self._key(x)
+            if k not in self.evals and k not in [self._key(n) for n in new]:
+                new.append(x)
+        cfgs = [dict(self.cfg, **x) for x in new]
+        errs = scn.workerMap(_evaluate, cfgs, pool, self.state)
+        for x, e in zip(new, errs):
+            self.evals[self._key(x)] = e
+        return([self.evals[self._key(x)] for x in xs])
+
+    def explore(self,n,seed=None):
+        # 'n' candidates spread over the bounds, one per stratum of each
+        # parameter (a Latin hypercube); log parameters within 4x of x
+        rng = np.random.default_rng(seed)
+        xs = [dict(self.x) for i in range(n)]
+        for name in self.free:
+            lo, hi, first, scale = params[name]
+            u = (rng.permutation(n) + rng.random(n)) / n
+            for x, f in zip(xs, u):
+                if scale == 'log':
+                    v = self.x[name] * 4.0 ** (2*f - 1)
+                else:
+                    v = lo + f * (hi - lo)
+                x[name] = float(min(max(v, lo), hi))
+        return(xs)
+
+    def fit(self,rounds=50,tol=1e-3,explore=16,seed=None,quiet=True):
+        # from the best of x and 'explore' spread candidates, pattern
+        # search until every step is below 'tol' of its first
+        pool = scn.pool(self.jobs, self.state)
+        try:
+            xs = [self.x] + self.explore(explore, seed)
+            errs = self.evaluate(xs, pool)
+            best = int(np.argmin(errs))
+            self.x, self.err = xs[best], errs[best]
+            for r in range(rounds):
+                xs = [self._moved(name, sign) for name in self.free
+                      for sign in (+1, -1)]
+                errs = self.evaluate(xs, pool)
+                best = int(np.argmin(errs))
+                if errs[best] < self.err:
+                    self.x, self.err = xs[best], errs[best]
+                else:
+                    for name in self.free:
+                        self.step[name] /= 2
+                self.history.append((dict(self.x), self.err))
+                if not quiet:
+                    print('%3d  %.6g  %s' % (r, self.err, json.dumps(self.x)))
+                if all(self.step[name] < tol * params[name][2]
+                       for name in self.free):
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return(self)
+
+    def result(self):
+        return({'params': dict(self.x), 'error': self.err,
+                'runs': len(self.evals), 'rounds': len(self.history)})
+
+##############################################################################
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Fit TEG_model3 losses to '
+                                 'measured traces')
+    ap.add_argument('measured', help='CSV: time, then Vstor/Vbat/Vout')
+    ap.add_argument('--fit', nargs='+', default=['loss_cold', 'loss_warm',
+                    'conv_loss'], choices=list(params),
+                    help='parameters to fit')
+    ap.add_argument('--set', nargs='+', default=[], metavar='NAME=value',
+                    help='scenario settings, values as JSON')
+    ap.add_argument('--jobs', type=int, default=None,
+                    help='worker processes (default: all cores)')
+    ap.add_argument('--rounds', type=int, default=50)
+    ap.add_argument('--explore', type=int, default=16,
+                    help='spread candidates to start from the best of')
+    ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--tol', type=float, default=1e-3,
+                    help='stop when the steps are this fraction of the first')
+    ap.add_argument('--cache', default=None, metavar='DIR',
+                    help='reuse the results of identical runs from DIR')
+    ap.add_argument('--out', default=None, help='JSON file for the result')
+    args = ap.parse_args(argv)
+    try:
+        cfg = scn.settings(args.set)
+    except ValueError as e:
+        ap.error(str(e))
+    cal = calibration(readMeasured(args.measured), args.fit, cfg,
+                      jobs=args.jobs, cache=args.cache)
+    res = cal.fit(args.rounds, args.tol, args.explore, args.seed,
+                  quiet=False).result()
+    for name, value in res.items():
+        print('%-8s %s' % (name, value))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(dict(res, config=cal.cfg), f, indent=1)
+    return(cal)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
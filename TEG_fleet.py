@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+A fleet of deployed TEG_model3 nodes, each with its own TEG trace and load
+
+All nodes run under one Harvest3 clock as a single HarvestNP.fleet process,
+their state in arrays, and the result is the spread across the fleet of the
+uptime and of the time to batOK
+
+    python TEG_fleet.py -N 500 --within 30 --out nodes.csv
+    python TEG_fleet.py --nodes nodes.json
+"""
+
+import csv
+import sys
+import json
+import argparse
+import numpy as np
+import simpy
+import Harvest3 as hvst
+import HarvestNP as hnp
+import TEG_scenario as scn
+
+# node settings that 'spread' varies: relative 1-sigma deviations
+spreads = {
+    'Tscale': 0.20,  # how fast the TEG heats and cools at each site
+    'Pscale': 0.30,  # TEG output at each site
+}
+
+# N node configs, the settings in 'spreads' drawn around the config's own
+def spread(N,cfg={},dev=spreads,loads=None,seed=None):
+    cfg = dict(scn.defaults, **cfg)
+    rng = np.random.default_rng(seed)
+    nodes = [{} for i in range(N)]
+    for name, rel in dev.items():
+        for node, x in zip(nodes, rng.normal(0, rel, N)):
+            node[name] = cfg[name] * max(1 + x, 0.05)
+    if loads:  # a mix of load models, e.g. ('dsply', 'load')
+        for node, load in zip(nodes, rng.choice(loads, N)):
+            node['load'] = str(load)
+    return(nodes)
+
+##############################################################################
+# The nodes of 'nodes', each a dict of TEG_scenario settings over 'cfg'
+class fleet:
+    def __init__(self,nodes,cfg={},traces={},every=100):
+        self.cfg = cfg = dict(scn.defaults, **cfg)
+        self.nodes = nodes = [dict(cfg, **node) for node in nodes]
+        self.N = N = len(nodes)
+        col = lambda name: np.array([node[name] for node in nodes])
+        traces = dict(scn.readTraces(*[node for node in nodes
+                                       if node['teg_file'] not in traces]),
+                      **traces)
+        self.Pin = hnp.stack.read([node['teg_file'] for node in nodes],
+                                  Tscale=col('Tscale'),
+                                  Pscale=col('Pscale'), traces=traces)
+        dsply = [node['load'] == 'dsply' for node in nodes]
+        loads = hnp.stack.read([node['dsply_file'] for node in nodes],
+                               traces=traces).traces
+        self.Pld = hnp.stack([ld if d else node['Vout'] * node['Iout']
+                              for ld, d, node in zip(loads, dsply, nodes)])
+        self.doList = None
+        if not all(dsply):
+            self.doList = [None if d else node['doList']
+                           for d, node in zip(dsply, nodes)]
+        self.env = env = simpy.Environment()
+        self.clk = hvst.clock(env, cfg['clock_period'], verbose=False)
+        self.fleet = hnp.fleet(env, self.clk, N, self.Pin, self.Pld,
+                               self.doList, every=every,
+                               Cstor=col('Stor'), Cbat=col('Bat'),
+                               Vout=col('Vout'), loss_cold=col('loss_cold'),
+                               loss_warm=col('loss_warm'),
+                               conv_loss=col('conv_loss'),
+                               chgen=col('chgen'), bat_ok=col('bat_ok'),
+                               bat_ov=col('bat_ov'))
+
+    def run(self):
+        self.env.run(until=self.cfg['stop_time'])
+        return(self)
+
+    def stats(self,within=30):
+        return(self.fleet.stats(within))
+
+    def save(self,fname):
+        # one row per node: its varied settings and its results
+        varied = sorted({name for node in self.nodes for name in node
+                         if node[name] != self.cfg[name]})
+        rows = self.fleet.table()
+        with open(fname, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(varied + list(rows[0]))
+            for node, row in zip(self.nodes, rows):
+                out.writerow([node[name] for name in varied] +
+                             list(row.values()))
+
+##############################################################################
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Simulate a fleet of nodes')
+    ap.add_argument('-N', type=int, default=100, help='number of nodes')
+    ap.add_argument('--nodes', default=None,
+                    help='JSON list of per-node settings, instead of -N')
+    ap.add_argument('--within', type=float, default=30,
+                    help='deadline for reaching bat_ok, seconds')
+    ap.add_argument('--loads', nargs='+', default=None,
+                    help="with -N, a random mix of 'dsply' and 'load'")
+    ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--every', type=int, default=100,
+                    help='record every n-th tock')
+    ap.add_argument('--out', default=None, help='CSV file, one row per node')
+    args = ap.parse_args(argv)
+    if args.nodes:
+        with open(args.nodes) as f:
+            nodes = json.load(f)
+    else:
+        nodes = spread(args.N, loads=args.loads, seed=args.seed)
+    fl = fleet(nodes, every=args.every).run()
+    for name, value in fl.stats(args.within).items():
+        print('%-14s %s' % (name, value))
+    if args.out:
+        fl.save(args.out)
+    return(fl)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
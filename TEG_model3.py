@@ -3,13 +3,24 @@
 Created on Mon May  7 14:47:28 2018
 
 @author: mlgkschm
+
+Run as a script to simulate and plot, or headless:
+
+    python TEG_model3.py --set load=load Bat=23.2e-3 --out results --png
+    python TEG_model3.py --config scenario.json --out results
+    python TEG_model3.py --cache __resultcache__ --out results
+
+'--out' writes metrics.json and traces.npz; '--png' then draws the figures
+to PNG files in a worker process.  matplotlib is only imported to plot
 """
 
-import simpy
-import Harvest3 as hvst
-from Harvest3 import list_m
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import TEG_scenario as scn
+import TEG_cache
 
 clock_period = 0.001
 stop_time = 50
@@ -19,145 +30,89 @@ Stor = 4.7e-6  # Farads
 Bat = 52.5e-3  # Farads
 Vout = 2.5
 Iout = 50e-3  # used by 'load', not by 'dsply'
+spill = None  # a folder name streams the probe traces to disk, for long runs
 
-###################################################
-
-# create the SimPy environment
-env = simpy.Environment()
-# create the timing clock
-clk = hvst.clock(env,clock_period)
-# Import the TEG model, from measured data
-teg = hvst.Psrc(env,unit=1,fname="teg_data.csv")
-# Create the Cstor and Cbat capacitor models
-Cstor = hvst.cap(env,Stor,unit="stor")
-Cbat = hvst.cap(env,Bat,unit="bat")
-# Create the energy harvester half of the bq25570 chip, the input
-harvester = hvst.harvester(env,clk,teg,Cstor,Cbat,unit=1)
-
-# Option 1: Create a current load model
-load = hvst.sink(env,I=Iout)
-# Option 2: Create the software driven display model, from measured data
-dsply = hvst.Psrc(env,unit=1,fname="display_data.csv")
-
-# Use Iload to switch between the two load models:
-Iload = dsply  # Switched current load model
-#Iload = dsply  # Display model
-
-# Create the buck converter half of the bq25570 chip, the output
-buckOut = hvst.converter(env,clk,harvester,Vout,Iload,unit=1,en=True)
-
-# Create 'switch', an object to turn the load on and off
-if Iload == load:
-    doList = [1,4,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3]
-    switch = hvst.OnOff(env,clk,doList,buckOut)
+# Use load to switch between the two load models:
+load = 'dsply'  # Display model, from measured data
+#load = 'load'  # Switched current load model, turned on and off by doList
+doList = [1,4,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3]
 
 ###################################################
-# Probe the simulation in preparation of plotting data
 
-prb_teg   = hvst.scope(env,clk,(teg,'P'))
-prb_Utot  = hvst.scope(env,clk,(teg,'Utot'))
-prb_nowP  = hvst.scope(env,clk,(teg,'nowP'))
-prb_Iout  = hvst.scope(env,clk,(buckOut,'I'))
-prb_Vout  = hvst.scope(env,clk,(buckOut,'V'))
-prb_Vstor = hvst.scope(env,clk,(Cstor,'V'))
-prb_Vbat  = hvst.scope(env,clk,(Cbat,'V'))
-prb_Qstor = hvst.scope(env,clk,(Cstor,'Q'))
-prb_Qbat  = hvst.scope(env,clk,(Cbat,'Q'))
-prb_HdU   = hvst.scope(env,clk,(harvester,'dU'))
-prb_BdU   = hvst.scope(env,clk,(buckOut,'dU'))
-prb_Utot  = hvst.scope(env,clk,(harvester,'Ustored'))
-prb_HdQ   = hvst.scope(env,clk,(harvester,'dQ'))
+# The scenario config of the settings above, with any overrides
+def config(**cfg):
+    base = dict(clock_period=clock_period, stop_time=stop_time, Stor=Stor,
+                Bat=Bat, Vout=Vout, Iout=Iout, spill=spill, load=load,
+                doList=doList)
+    return(dict(scn.defaults, **dict(base, **cfg)))
+
+# Build the simulation and run it!  See TEG_scenario for the components
+def simulate(cfg=None,quiet=False):
+    return(scn.scenario(config() if cfg is None else cfg).run(quiet=quiet))
+
+# Write the metrics and the probe traces of a run to folder 'outdir'
+# 'res' is a TEG_cache.result, or a scenario that has run
+def save(res,outdir):
+    if isinstance(res, scn.scenario):
+        res = TEG_cache.result.fromScenario(res)
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, 'metrics.json'), 'w') as f:
+        json.dump({'config': res.cfg, 'metrics': res.metrics}, f, indent=1)
+    log = res.stateLog
+    arrays = {'log_time': np.array(log['time'], dtype=float),
+              'log_data': np.array(log['data'], dtype=str)}
+    for name, p in res.prb.items():
+        arrays['time_' + name] = p.time
+        arrays['data_' + name] = p.data
+    fname = os.path.join(outdir, 'traces.npz')
+    np.savez(fname, **arrays)
+    return(fname)
 
 ###################################################
-# Run the simulation!
-if stop_time == None:
-    env.run()
-else:
-    env.run(until=stop_time)
-# All done! mark end of time and finish the bq25570 state log
-print('Time stop: @ %f' % env.now)
-harvester.logState()
-
-###################################################
-# Plot the data collected by the scope probes above
-
-fontsize='x-large'
-
-plt.figure()  # plot state history
-plt.plot(harvester.stateLog['time'], harvester.stateLog['data'], label='Hvst State')
-plt.title('Hvst State', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('State', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-
-plt.figure()  # plot change in energy from TEG and load
-plt.plot(prb_teg.time, prb_teg.data, label='teg P')
-plt.plot(prb_Utot.time, prb_Utot.data, label='teg Utot')
-plt.title('Energy', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Energy (J)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-
-"""
-plt.figure()  # plot change in energy from TEG and load
-plt.plot(prb_nowP.time, prb_nowP.data, label='teg nowP')
-plt.title('Energy', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Energy (J)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-"""
-
-"""
-plt.figure()  # plot change in energy from TEG and load
-plt.plot(prb_HdU.time, prb_HdU.data, label='Hvst dU')
-plt.plot(prb_BdU.time, prb_BdU.data, label='Buck dU')
-plt.plot(prb_Utot.time, list_m(prb_HdU.data,prb_BdU.data), label='Diff dU')
-plt.title('delta Energy', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Energy (J)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-"""
-
-plt.figure()  # plot total voltage stored
-plt.plot(prb_Vstor.time, prb_Vstor.data, label='Cstor V')
-plt.plot(prb_Vbat.time, prb_Vbat.data, label='Cbat V')
-plt.title('Cap V', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Volts', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-
-plt.figure()  # plot total current drawn by load
-plt.plot(prb_Iout.time, prb_Iout.data, label='Iout')
-plt.title('Load Current', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Current(a)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-
-plt.figure()  # plot total current drawn by load
-plt.plot(prb_Vout.time, prb_Vout.data, label='Vout')
-plt.title('Output Voltage', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Volts (v)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-
-"""
-plt.figure()  # plot total charge stored
-plt.plot(prb_Qstor.time, prb_Qstor.data, label='Cstor Q')
-plt.title('Cstor Q', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Charge', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-"""
-
-"""
-plt.figure()  # plot change in cap charge
-plt.plot(prb_HdQ.time, prb_HdQ.data, label='Hvst dQ')
-plt.title('Cap Change of Charge', fontsize=fontsize)
-plt.xlabel('Time (s)', fontsize=fontsize)
-plt.ylabel('Charge (C)', fontsize=fontsize)
-plt.legend(fontsize=fontsize)
-"""
-
-###################################################
-###################################################
-###################################################
+# command line: settings from a JSON config and NAME=value overrides
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Run the TEG_model3 scenario')
+    ap.add_argument('--config', default=None,
+                    help='JSON file of TEG_scenario settings')
+    ap.add_argument('--set', nargs='+', default=[], metavar='NAME=value',
+                    help='override settings, values as JSON')
+    ap.add_argument('--out', default=None,
+                    help='folder for metrics.json and traces.npz')
+    ap.add_argument('--png', action='store_true',
+                    help='with --out, draw the figures to PNG files')
+    ap.add_argument('--extra', action='store_true',
+                    help='also the energy and charge detail figures')
+    ap.add_argument('--cache', default=None, metavar='DIR',
+                    help='reuse the results of identical runs from DIR')
+    ap.add_argument('--quiet', action='store_true')
+    args = ap.parse_args(argv)
+    cfg = {}
+    if args.config:
+        with open(args.config) as f:
+            cfg.update(json.load(f))
+    try:
+        cfg.update(scn.settings(args.set))
+    except ValueError as e:
+        ap.error(str(e))
+    if args.cache:
+        res = TEG_cache.cache(args.cache).run(config(**cfg))
+    else:
+        res = TEG_cache.result.fromScenario(simulate(config(**cfg),
+                                                     quiet=args.quiet))
+    if not args.out:  # interactive, as the script always was
+        import TEG_plot
+        prb = {name: (p.time, p.data) for name, p in res.prb.items()}
+        TEG_plot.show(res.stateLog, prb, args.extra)
+        return(res)
+    fname = save(res, args.out)
+    for name, value in res.metrics.items():
+        print('%-8s %s' % (name, value))
+    if args.png:
+        import TEG_plot  # matplotlib only in the worker process
+        for f in TEG_plot.renderAsync(fname, args.out, args.extra).result():
+            print(f)
+    return(res)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo tolerance analysis of a TEG_model3 scenario
+
+All N random builds are advanced together by HarvestNP.batch
+
+    python TEG_montecarlo.py -N 2000 --within 30 --out bands.csv
+"""
+
+import csv
+import sys
+import argparse
+import numpy as np
+import HarvestNP as hnp
+import TEG_scenario as scn
+
+# relative 1-sigma tolerances of the scenario parameters
+tolerances = {
+    'Stor': 0.10,  # Cstor
+    'Bat': 0.20,  # Cbat, supercap
+    'loss_cold': 0.02,
+    'loss_warm': 0.10,
+    'Pscale': 0.10,  # TEG module output
+    'conv_loss': 0.10,
+}
+
+# Draw N values of each toleranced parameter around the config's nominal
+def draw(N,cfg={},tol=tolerances,dist='normal',seed=None):
+    cfg = dict(scn.defaults, **cfg)
+    rng = np.random.default_rng(seed)
+    values = {}
+    for name, rel in tol.items():
+        if dist == 'uniform':
+            dev = rng.uniform(-rel, rel, N)
+        else:
+            dev = rng.normal(0, rel, N)
+        values[name] = cfg[name] * (1 + dev)
+        if 'loss' in name:  # losses stay fractions
+            values[name] = np.clip(values[name], 0, 0.999)
+    return(values)
+
+##############################################################################
+# N builds of the scenario in 'cfg', with parameters from 'draw'
+class montecarlo:
+    def __init__(self,N=1000,cfg={},tol=tolerances,dist='normal',seed=None,
+                 traces={}):
+        self.cfg = cfg = dict(scn.defaults, **cfg)
+        self.values = draw(N, cfg, tol, dist, seed)
+        p = dict(cfg, **self.values)
+        self.N = N
+        self.batch = hnp.batch(N, cfg['clock_period'], p['Stor'], p['Bat'],
+                               Vout=cfg['Vout'], loss_cold=p['loss_cold'],
+                               loss_warm=p['loss_warm'],
+                               conv_loss=p['conv_loss'], chgen=p['chgen'],
+                               bat_ok=p['bat_ok'], bat_ov=p['bat_ov'])
+        self.Pin = hnp.trace.read(cfg['teg_file'], Tscale=cfg['Tscale'],
+                                  scale=p['Pscale'],
+                                  trace=traces.get(cfg['teg_file']))
+        self.doList = None
+        if cfg['load'] == 'dsply':
+            self.Pld = hnp.trace.read(cfg['dsply_file'],
+                                      trace=traces.get(cfg['dsply_file']))
+        else:
+            self.Pld = cfg['Vout'] * cfg['Iout']
+            self.doList = cfg['doList']
+
+    def run(self,every=100):
+        self.batch.run(self.cfg['stop_time'], self.Pin, self.Pld,
+                       doList=self.doList, every=every)
+        return(self)
+
+    @property
+    def time(self):
+        return(self.batch.time)
+
+    def bands(self,name,pct=(5, 50, 95)):
+        return(self.batch.bands(name, pct))
+
+    def stats(self,within=30):
+        # yield figures across the N builds
+        b = self.batch
+        tOK = b.tBatOK
+        reached = tOK[~np.isnan(tOK)]
+        return({'N': self.N,
+                'yield_batOK': b.fraction(tOK, within),
+                'yield_warm': b.fraction(
+                        b.tFirst[:, hnp.codes[hnp.st['warm']]], within),
+                'tBatOK_p50': float(np.median(reached)) if len(
+                        reached) else None,
+                'tBatOK_p95': float(np.percentile(reached, 95)) if len(
+                        reached) else None,
+                'uptime_p5': float(np.percentile(b.uptime, 5)),
+                'uptime_p50': float(np.median(b.uptime)),
+                'Vbat_p5': float(np.percentile(b.Vbat, 5)),
+                'Vbat_p50': float(np.median(b.Vbat))})
+
+    def save(self,fname,pct=(5, 50, 95)):
+        # percentile bands of Vstor and Vbat, one row per recorded tock
+        cols, data = ['time'], [self.time]
+        for name in ('Vstor', 'Vbat'):
+            cols += ['%s_p%g' % (name, p) for p in pct]
+            data += list(self.bands(name, pct))
+        with open(fname, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(cols)
+            out.writerows(np.array(data).T.tolist())
+
+##############################################################################
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Monte Carlo tolerance run')
+    ap.add_argument('-N', type=int, default=1000, help='number of builds')
+    ap.add_argument('--within', type=float, default=30,
+                    help='yield deadline for reaching bat_ok, seconds')
+    ap.add_argument('--load', default=None, help="'dsply' or 'load'")
+    ap.add_argument('--dist', default='normal', help="'normal' or 'uniform'")
+    ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--every', type=int, default=100,
+                    help='record every n-th tock')
+    ap.add_argument('--out', default=None, help='CSV file for the bands')
+    args = ap.parse_args(argv)
+    cfg = {} if args.load is None else {'load': args.load}
+    mc = montecarlo(args.N, cfg, dist=args.dist, seed=args.seed).run(
+            every=args.every)
+    for name, value in mc.stats(args.within).items():
+        print('%-12s %s' % (name, value))
+    if args.out:
+        mc.save(args.out)
+    return(mc)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
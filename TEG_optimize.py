@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Size the TEG_model3 parts: the smallest Bat/Stor that meet a target, or the
+Vout that does best
+
+'smallest' brackets the boundary of the target and cuts the bracket into
+k+1 parts a round, the k new candidates run together in a process pool
+(k=1 is bisection).  Every run is kept and reused by later rounds and
+searches, and with --cache by later invocations too
+
+    python TEG_optimize.py Bat=1e-3,0.1 --metric uptime --target 0.75
+    python TEG_optimize.py Bat=1e-3,0.1 Stor=1e-6,1e-4 --target 0.9
+    python TEG_optimize.py Vout=1.8,3.3 --maximize uptime --set load=load
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import TEG_scenario as scn
+import TEG_cache
+
+def _run(cfg):
+    # the metrics of 'cfg', None when the model fails, e.g. a cap drained
+    # below empty
+    traces, cache = scn.worker['traces'], scn.worker['cache']
+    try:
+        if cache is not None:
+            return(cache.run(cfg, traces).metrics)
+        return(scn.run(cfg, traces))
+    except scn.failures:
+        return(None)
+
+##############################################################################
+# Runs candidates of the scenario 'cfg', each one only once
+class evaluator:
+    def __init__(self,cfg={},jobs=None,cache=None,traces=None):
+        self.cfg = cfg = dict(scn.defaults, **cfg)
+        if isinstance(cache, str):
+            cache = TEG_cache.cache(cache)
+        self.cache = cache
+        self.traces = scn.readTraces(cfg) if traces is None else traces
+        self.jobs = jobs or os.cpu_count()
+        self.evals = {}  # candidate -> metrics
+        self.state = {'traces': self.traces, 'cache': cache}
+        self.pool = scn.pool(self.jobs, self.state)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _key(self,x):
+        return(tuple(sorted((k, round(float(v), 15)) for k, v in x.items())))
+
+    def metrics(self,xs):
+        # the metrics of each candidate in 'xs', dicts of settings over
+        # 'cfg'; the new ones run concurrently
+        new = {}
+        for x in xs:
+            k = self._key(x)
+            if k not in self.evals:
+                new[k] = dict(self.cfg, **x)
+        res = scn.workerMap(_run, list(new.values()), self.pool, self.state)
+        self.evals.update(zip(new, res))
+        return([self.evals[self._key(x)] for x in xs])
+
+# Whether metrics 'm' meet 'target' for 'metric': at least, or at most
+def meets(m,metric,target,atLeast=True):
+    if m is None or m.get(metric) is None:
+        return(False)
+    return(m[metric] >= target if atLeast else m[metric] <= target)
+
+##############################################################################
+# searches
+
+# The smallest value of setting 'name' in [lo, hi] whose run meets the
+# target, to a relative 'rtol'; None if 'hi' does not.  Assumes the runs
+# meet it from some value on; 'log' cuts the bracket on a log scale
+def smallest(ev,name,lo,hi,metric='uptime',target=0.9,atLeast=True,
+             fixed={},k=None,rtol=0.01,log=True):
+    k = k or ev.jobs
+    ok = lambda ms: [meets(m, metric, target, atLeast) for m in ms]
+    x = lambda v: dict(fixed, **{name: float(v)})
+    first = ok(ev.metrics([x(lo), x(hi)]))
+    if first[0]:
+        return(float(lo))
+    if not first[1]:
+        return(None)
+    a, b = lo, hi  # a fails, b meets the target
+    while (b/a - 1 if log else (b-a)/b) > rtol:
+        f = np.arange(1, k+1) / (k+1)
+        pts = a * (b/a)**f if log else a + (b-a)*f
+        hits = ok(ev.metrics([x(v) for v in pts]))
+        j = hits.index(True) if True in hits else k
+        a = pts[j-1] if j > 0 else a
+        b = pts[j] if j < k else b
+    return(float(b))
+
+# The value of 'name' in [lo, hi] with the highest (or lowest) 'metric':
+# k+2 points a round over the bracket, narrowed to the best's neighbours,
+# so k is at least 2 for it to shrink; at most 'rounds' rounds
+def best(ev,name,lo,hi,metric='uptime',maximize=True,fixed={},k=None,
+         rtol=0.01,log=False,rounds=100):
+    k = max(k or ev.jobs, 2)
+    sign = 1 if maximize else -1
+    a, b = lo, hi
+    for r in range(rounds):
+        f = np.arange(k+2) / (k+1)
+        pts = a * (b/a)**f if log else a + (b-a)*f
+        ms = ev.metrics([dict(fixed, **{name: float(v)}) for v in pts])
+        score = [sign * m[metric] if m and m.get(metric) is not None
+                 else -np.inf for m in ms]
+        j = int(np.argmax(score))
+        if (b/a - 1 if log else (b-a)/max(abs(b), 1e-30)) <= rtol:
+            break
+        a, b = pts[max(j-1, 0)], pts[min(j+1, k+1)]
+    return(float(pts[j]), ms[j])
+
+# The smallest values of several settings that together meet the target:
+# each in turn is made as small as it can be with the others held, until a
+# round changes none of them.  'bounds' is {name: (lo, hi)}; starts at hi
+def sizing(ev,bounds,metric='uptime',target=0.9,atLeast=True,rounds=4,
+           k=None,rtol=0.01):
+    x = {name: float(hi) for name, (lo, hi) in bounds.items()}
+    if not meets(ev.metrics([x])[0], metric, target, atLeast):
+        return(None)
+    for r in range(rounds):
+        prev = dict(x)
+        for name, (lo, hi) in bounds.items():
+            fixed = {n: v for n, v in x.items() if n != name}
+            x[name] = smallest(ev, name, lo, x[name], metric, target,
+                               atLeast, fixed, k, rtol)
+        if x == prev:
+            break
+    return(x)
+
+##############################################################################
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Size TEG_model3 parts')
+    ap.add_argument('bounds', nargs='+', metavar='NAME=lo,hi',
+                    help='settings to search and their ranges')
+    ap.add_argument('--metric', default='uptime',
+                    help='scenario metric of the target (default: uptime)')
+    ap.add_argument('--target', type=float, default=None,
+                    help='smallest settings with metric >= target')
+    ap.add_argument('--at-most', action='store_true',
+                    help='the target is a maximum, e.g. for tBatOK')
+    ap.add_argument('--maximize', default=None, metavar='METRIC',
+                    help='instead, the one setting that maximizes METRIC')
+    ap.add_argument('--minimize', default=None, metavar='METRIC',
+                    help='instead, the one setting that minimizes METRIC')
+    ap.add_argument('--set', nargs='+', default=[], metavar='NAME=value',
+                    help='scenario settings, values as JSON')
+    ap.add_argument('--jobs', type=int, default=None,
+                    help='worker processes (default: all cores)')
+    ap.add_argument('-k', type=int, default=None,
+                    help='candidates per round (default: --jobs)')
+    ap.add_argument('--rtol', type=float, default=0.01)
+    ap.add_argument('--cache', default=None, metavar='DIR',
+                    help='reuse the results of identical runs from DIR')
+    args = ap.parse_args(argv)
+    try:
+        cfg = scn.settings(args.set)
+    except ValueError as e:
+        ap.error(str(e))
+    bounds = {}
+    for item in args.bounds:
+        name, _, text = item.partition('=')
+        if name not in scn.defaults:
+            ap.error('unknown setting: %s' % name)
+        lo, hi = (float(v) for v in text.split(','))
+        bounds[name] = (lo, hi)
+    goal = args.maximize or args.minimize
+    if goal and len(bounds) != 1:
+        ap.error('--maximize/--minimize search one setting')
+    if not goal and args.target is None:
+        ap.error('give --target, or --maximize/--minimize')
+    with evaluator(cfg, args.jobs, args.cache) as ev:
+        if goal:
+            (name, (lo, hi)), = bounds.items()
+            value, m = best(ev, name, lo, hi, goal, bool(args.maximize),
+                            k=args.k, rtol=args.rtol)
+            res = {name: value, goal: m[goal] if m else None}
+        else:
+            res = sizing(ev, bounds, args.metric, args.target,
+                         not args.at_most, k=args.k, rtol=args.rtol)
+            if res is None:
+                print('target not met within the bounds')
+                return(None)
+            res[args.metric] = ev.metrics([{n: res[n] for n in bounds}])[0][
+                    args.metric]
+        print(json.dumps(res))
+        print('runs     %d' % len(ev.evals))
+    return(res)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
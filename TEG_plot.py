@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+The TEG_model3 figures, from a saved run
+
+matplotlib is imported only when a figure is drawn, and 'renderAsync'
+draws them to PNG files in a worker process
+
+    python TEG_plot.py results/traces.npz --out results
+"""
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Harvest3 import Trace
+
+fontsize = 'x-large'
+
+# The probes and state log of a run, as saved by TEG_model3.save
+def load(fname):
+    with np.load(fname) as f:
+        log = {'time': f['log_time'], 'data': f['log_data']}
+        prb = {k[len('time_'):]: (f[k], f['data_' + k[len('time_'):]])
+               for k in f.files if k.startswith('time_')}
+    return(log, prb)
+
+def _figure(plt,title,ylabel,lines):
+    fig = plt.figure()
+    for time, data, label in lines:
+        plt.plot(time, data, label=label)
+    plt.title(title, fontsize=fontsize)
+    plt.xlabel('Time (s)', fontsize=fontsize)
+    plt.ylabel(ylabel, fontsize=fontsize)
+    plt.legend(fontsize=fontsize)
+    return(fig)
+
+# The figures of TEG_model3; 'extra' adds the ones it kept commented out
+def figures(log,prb,plt,extra=False):
+    figs = [('state', _figure(plt, 'Hvst State', 'State',
+                              [(log['time'], log['data'], 'Hvst State')])),
+            ('energy', _figure(plt, 'Energy', 'Energy (J)',
+                               [prb['teg'] + ('teg P',),
+                                prb['Ustored'] + ('teg Utot',)]))]
+    if extra:
+        dU = Trace(*prb['HdU']) + Trace(*prb['BdU'])
+        dU = dU.time, dU.data
+        figs += [('nowP', _figure(plt, 'Energy', 'Energy (J)',
+                                  [prb['nowP'] + ('teg nowP',)])),
+                 ('dU', _figure(plt, 'delta Energy', 'Energy (J)',
+                                [prb['HdU'] + ('Hvst dU',),
+                                 prb['BdU'] + ('Buck dU',),
+                                 dU + ('Diff dU',)]))]
+    figs += [('capV', _figure(plt, 'Cap V', 'Volts',
+                              [prb['Vstor'] + ('Cstor V',),
+                               prb['Vbat'] + ('Cbat V',)])),
+             ('Iout', _figure(plt, 'Load Current', 'Current(a)',
+                              [prb['Iout'] + ('Iout',)])),
+             ('Vout', _figure(plt, 'Output Voltage', 'Volts (v)',
+                              [prb['Vout'] + ('Vout',)]))]
+    if extra:
+        figs += [('Qstor', _figure(plt, 'Cstor Q', 'Charge',
+                                   [prb['Qstor'] + ('Cstor Q',)])),
+                 ('HdQ', _figure(plt, 'Cap Change of Charge', 'Charge (C)',
+                                 [prb['HdQ'] + ('Hvst dQ',)]))]
+    return(figs)
+
+# Draw the figures on screen
+def show(log,prb,extra=False):
+    import matplotlib.pyplot as plt
+    figs = figures(log, prb, plt, extra)
+    plt.show()
+    return(figs)
+
+# Draw the figures of a saved run to PNG files in 'outdir'
+def render(fname,outdir,extra=False,dpi=100):
+    import matplotlib
+    matplotlib.use('Agg')  # no display needed
+    import matplotlib.pyplot as plt
+    log, prb = load(fname)
+    os.makedirs(outdir, exist_ok=True)
+    files = []
+    for name, fig in figures(log, prb, plt, extra):
+        files.append(os.path.join(outdir, name + '.png'))
+        fig.savefig(files[-1], dpi=dpi)
+        plt.close(fig)
+    return(files)
+
+# 'render' in a worker process; returns a future of the file names
+def renderAsync(fname,outdir,extra=False,dpi=100):
+    pool = ProcessPoolExecutor(max_workers=1)
+    future = pool.submit(render, fname, outdir, extra, dpi)
+    pool.shutdown(wait=False)
+    return(future)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Plot a saved TEG_model3 run')
+    ap.add_argument('traces', help='traces.npz from TEG_model3 --out')
+    ap.add_argument('--out', default=None,
+                    help='folder for PNG files (default: show on screen)')
+    ap.add_argument('--extra', action='store_true',
+                    help='also the energy and charge detail figures')
+    args = ap.parse_args(argv)
+    if args.out:
+        for f in render(args.traces, args.out, args.extra):
+            print(f)
+    else:
+        show(*load(args.traces), extra=args.extra)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Build and run a TEG_model3 scenario from a config dict
+
+A run can be checkpointed part way and forked, e.g. to try many loads from
+the same charged-up state; a fork's metrics cover the whole run from t=0,
+and it may change anything but the caps:
+
+    ck = scenario(cfg).runTo(20).checkpoint()
+    for load in ('dsply', 'load'):
+        scenario({'load': load}, checkpoint=ck).run()
+"""
+
+import io
+import json
+import pickle
+import contextlib
+from multiprocessing import Pool
+import simpy
+import Harvest3 as hvst
+
+# The TEG_model3 set-up; any key can be overridden in a scenario config
+defaults = {
+    'clock_period': 0.001,
+    'stop_time': 50,
+    'Stor': 4.7e-6,  # Farads
+    'Bat': 52.5e-3,  # Farads
+    'Vout': 2.5,
+    'Iout': 50e-3,  # used by 'load', not by 'dsply'
+    'load': 'dsply',  # 'dsply' or 'load'
+    'doList': [1,4,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3],
+    'teg_file': 'teg_data.csv',
+    'dsply_file': 'display_data.csv',
+    'Tscale': 1,  # TEG trace scaling
+    'Pscale': 1,
+    'cache': True,  # load traces via their compiled, memory-mapped copies
+    'table': False,  # compute the input powers ahead on the clock ticks
+    'spill': None,  # folder to stream the probe traces to, for long runs
+    'profile': False,  # True, or a .json/.csv file: time every component
+    'ledger': None,  # keep energy accounts, a summary every n tocks
+    # stop early, before 'stop_time', once the outcome is settled
+    'stop_exhausted': False,  # the TEG trace has run out
+    'stop_uv': False,  # ... and Vbat is below bat_uv, or bat_ok: output off
+    'stop_below': None,  # [probe, value, hold s]: held below, once above
+    'stop_steady': None,  # [probe, period s, tol]: repeats every period
+    'stop_every': 10,  # check on every n-th tock
+    # bq25570 harvester thresholds and losses
+    'coldstart': 0.1,
+    'chgen': 1.73,
+    'bat_uv': 2.0,
+    'bat_ok': 2.5,
+    'bat_ov': 5.5,
+    'loss_cold': 0.95,
+    'loss_warm': 0.25,
+    'conv_loss': 0.10,
+}
+
+# settings a fork of a checkpoint must keep: the saved charges are theirs
+fixed = ('Stor', 'Bat')
+
+# errors of a run that the model fails on, e.g. a cap drained below empty
+failures = (ValueError, ZeroDivisionError, OverflowError)
+
+# harvester attributes that a config may set
+hvst_params = ('coldstart', 'chgen', 'bat_uv', 'bat_ok', 'bat_ov',
+               'loss_cold', 'loss_warm')
+
+# Read the input traces of some configs once, to share between scenarios
+def readTraces(*cfgs):
+    traces = {}
+    for cfg in cfgs or [{}]:
+        cfg = dict(defaults, **cfg)
+        read = hvst.loadTrace if cfg['cache'] else hvst.readTrace
+        for key in ('teg_file', 'dsply_file'):
+            if cfg[key] not in traces:
+                traces[cfg[key]] = read(cfg[key])
+    return(traces)
+
+##############################################################################
+# One simulation: the objects of TEG_model3, built from 'cfg'
+# With a 'checkpoint' it carries on from there, 'cfg' overriding its config
+class scenario:
+    def __init__(self,cfg={},traces={},checkpoint=None):
+        ck = checkpoint
+        base = ck['cfg'] if ck else defaults
+        self.cfg = cfg = dict(base, **cfg)
+        # create the SimPy environment
+        self.env = env = simpy.Environment(ck['now'] if ck else 0)
+        # the run up to the checkpoint, for the metrics of the whole run
+        self.prior = ck['tally'] if ck else {'tBatOK': None, 'on': 0, 'n': 0}
+        # profile the run, patching before the components are built
+        self.prof = None
+        if cfg['profile']:
+            import HarvestProf
+            self.prof = HarvestProf.profiler(env,report=False).enable()
+        # create the timing clock
+        self.clk = clk = hvst.clock(env,cfg['clock_period'],
+                                    resume=ck['clock'] if ck else None)
+        if self.prof:
+            self.prof.clock = clk
+        # Import the TEG model, from measured data
+        self.teg = hvst.Psrc(env,unit=1,fname=cfg['teg_file'],
+                             Tscale=cfg['Tscale'],Pscale=cfg['Pscale'],
+                             trace=traces.get(cfg['teg_file']),
+                             cache=cfg['cache'],
+                             grid=clk if cfg['table'] else None)
+        # Create the Cstor and Cbat capacitor models
+        self.Cstor = hvst.cap(env,cfg['Stor'],unit="stor")
+        self.Cbat = hvst.cap(env,cfg['Bat'],unit="bat")
+        # Create the energy harvester half of the bq25570 chip, the input
+        self.harvester = hvst.harvester(env,clk,self.teg,self.Cstor,
+                                        self.Cbat,unit=1,start=not ck)
+        for name in hvst_params:
+            setattr(self.harvester, name, cfg[name])
+        # Create the load: a switched current load or the display model
+        if cfg['load'] == 'dsply':
+            self.Iload = hvst.Psrc(env,unit=1,fname=cfg['dsply_file'],
+                                   trace=traces.get(cfg['dsply_file']),
+                                   cache=cfg['cache'],
+                                   grid=clk if cfg['table'] else None)
+        else:
+            self.Iload = hvst.sink(env,I=cfg['Iout'])
+        # Create the buck converter half of the bq25570 chip, the output
+        self.buckOut = hvst.converter(env,clk,self.harvester,cfg['Vout'],
+                                      self.Iload,unit=1,en=True,start=not ck)
+        self.buckOut._loss = cfg['conv_loss']
+        self.buckOut.bat_ok = cfg['bat_ok']
+        # Create 'switch', an object to turn the load on and off
+        self.switch = None
+        if cfg['load'] != 'dsply':
+            self.switch = hvst.OnOff(env,clk,cfg['doList'],self.buckOut,
+                                     start=not ck)
+        if ck:
+            self._restore(ck)
+        # Probe the simulation, all nodes sampled by one process
+        self.prb = hvst.ProbeSet(env,clk,spill=cfg['spill'])
+        self.nodes = {}
+        for name, node in (('teg', (self.teg,'P')),
+                           ('Utot', (self.teg,'Utot')),
+                           ('nowP', (self.teg,'nowP')),
+                           ('Iout', (self.buckOut,'I')),
+                           ('Vout', (self.buckOut,'V')),
+                           ('Vstor', (self.Cstor,'V')),
+                           ('Vbat', (self.Cbat,'V')),
+                           ('Qstor', (self.Cstor,'Q')),
+                           ('Qbat', (self.Cbat,'Q')),
+                           ('HdU', (self.harvester,'dU')),
+                           ('BdU', (self.buckOut,'dU')),
+                           ('Ustored', (self.harvester,'Ustored')),
+                           ('HdQ', (self.harvester,'dQ')),
+                           ('batOK', (self.harvester,'batOK'))):
+            self.prb.add(name,node)
+            self.nodes[name] = node
+        self.stop = self._stopper(cfg)
+        # energy accounts, when asked for
+        self.ledger = None
+        if cfg['ledger']:
+            self.ledger = hvst.ledger(env,clk,self.harvester,self.buckOut,
+                                      every=cfg['ledger'])
+
+    def _stopper(self,cfg):
+        # the early-stop conditions of 'cfg', or None
+        env, clk, every = self.env, self.clk, cfg['stop_every']
+        conds = {}
+        if cfg['stop_exhausted']:
+            conds['exhausted'] = hvst.whenExhausted(self.teg)
+        if cfg['stop_uv']:
+            # the converter stops below bat_ok, so Vbat seldom reaches bat_uv
+            conds['uv'] = hvst.whenAll(
+                    hvst.whenExhausted(self.teg),
+                    hvst.whenCrossed(env, (self.Cbat,'V'), '<',
+                                     max(cfg['bat_uv'], cfg['bat_ok'])))
+        if cfg['stop_below']:
+            name, value, hold = cfg['stop_below']
+            conds['below'] = hvst.whenCrossed(env, self.nodes[name], '<',
+                                              value, hold, arm=True)
+        if cfg['stop_steady']:
+            name, period, tol = cfg['stop_steady']
+            conds['steady'] = hvst.whenSteady(clk, self.nodes[name], period,
+                                              tol, every)
+        if not conds:
+            return(None)
+        return(hvst.stopper(env, clk, conds, every))
+
+    def _restore(self,ck):
+        # set the saved state, then restart the processes as they were made
+        for k in fixed:
+            if ck['cfg'][k] != self.cfg[k]:
+                raise ValueError('a fork cannot change %s' % k)
+        same = all(ck['cfg'][k] == self.cfg[k] for k in ('load', 'doList'))
+        for name in ('teg', 'Cstor', 'Cbat', 'harvester', 'buckOut'):
+            hvst.setState(getattr(self, name), ck[name])
+        if same:  # the load carries on, else a new one starts now
+            hvst.setState(self.Iload, ck['Iload'])
+            if self.switch:
+                hvst.setState(self.switch, ck['switch'])
+        else:
+            self.buckOut.en = True
+        self.harvester.resume()
+        self.buckOut.resume()
+        if self.switch:
+            if same:
+                self.switch.resume()
+            else:
+                self.env.process(self.switch.run())
+
+    def checkpoint(self,fname=None):
+        # the state to carry on from, pickled to 'fname' if given
+        if not self.clk.running:
+            raise RuntimeError('checkpoint: the clock has stopped')
+        ck = {'now': self.env.now, 'cfg': dict(self.cfg),
+              'clock': hvst.getState(self.clk), 'tally': self.tally()}
+        for name in ('teg', 'Cstor', 'Cbat', 'harvester', 'Iload',
+                     'buckOut', 'switch'):
+            obj = getattr(self, name)
+            ck[name] = hvst.getState(obj) if obj else None
+        if fname:
+            with open(fname, 'wb') as f:
+                pickle.dump(ck, f)
+        return(ck)
+
+    def runTo(self,until,quiet=True):
+        # run part way, e.g. up to a checkpoint; 'run' finishes it
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else (
+                contextlib.nullcontext()):
+            self.env.run(until=until)
+        return(self)
+
+    def run(self,quiet=False):
+        # Run the simulation! 'quiet' drops the clock/source chatter
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else (
+                contextlib.nullcontext()):
+            if self.cfg['stop_time'] == None:
+                self.env.run()
+            else:
+                self.env.run(until=self.cfg['stop_time'])
+            # All done! mark end of time and finish the bq25570 state log
+            print('Time stop: @ %f' % self.env.now)
+            self.harvester.logState()
+            self.prb.close()
+            if self.ledger:
+                for name, U in self.ledger.add().items():
+                    print('%-10s %g' % (name, U))
+        if self.prof:
+            self.prof.disable()
+            self.prof.print()
+            if isinstance(self.cfg['profile'], str):
+                self.prof.save(self.cfg['profile'])
+        return(self)
+
+    def tally(self):
+        # the probed metrics so far, counting any run before a checkpoint:
+        # first time batOK, and tocks with and without Vout
+        tBatOK = self.prior['tBatOK']
+        if tBatOK is None:
+            ok = self.prb['batOK']
+            tBatOK = next((float(t) for t, d in zip(ok.time, ok.data) if d),
+                          None)
+        Vout = self.prb['Vout'].data
+        return({'tBatOK': tBatOK,
+                'on': self.prior['on'] + int((Vout > 0).sum()),
+                'n': self.prior['n'] + len(Vout)})
+
+    def metrics(self):
+        # summary of one run, for sweep tables
+        tWarm = self.harvester.stateLog.first()[hvst.st['warm']]
+        tally = self.tally()
+        return({'tWarm': tWarm,
+                'tBatOK': tally['tBatOK'],
+                'uptime': tally['on'] / tally['n'] if tally['n'] else 0,
+                'Ustored': self.harvester.Ustored,
+                'Vbat': self.Cbat.V,
+                'tStop': self.env.now,
+                'stopReason': self.stop.reason if self.stop else None})
+
+# Build, run and summarize one config
+def run(cfg={},traces={},quiet=True,checkpoint=None):
+    return(scenario(cfg,traces,checkpoint).run(quiet=quiet).metrics())
+
+# A checkpoint saved by 'scenario.checkpoint'
+def loadCheckpoint(fname):
+    with open(fname, 'rb') as f:
+        return(pickle.load(f))
+
+##############################################################################
+# for the command-line tools: settings, and process pools of scenario runs
+
+# literal words, as a config file in JSON would give them
+_words = {'True': True, 'False': False, 'None': None}
+
+# A setting's value from the command line: JSON, a word, a number JSON does
+# not take such as '.5', or a plain string, e.g. a file name
+def value(text):
+    if text in _words:
+        return(_words[text])
+    for parse in (json.loads, float):
+        try:
+            return(parse(text))
+        except ValueError:
+            pass
+    return(text)
+
+# Settings from NAME=value items; ValueError for an unknown name
+def settings(items):
+    cfg = {}
+    for item in items:
+        name, _, text = item.partition('=')
+        if name not in defaults:
+            raise ValueError('unknown setting: %s' % name)
+        cfg[name] = value(text)
+    return(cfg)
+
+# What the runs in this process share, e.g. the input traces and a result
+# cache: set once per pool worker by 'initWorker', from 'pool'
+worker = {}
+
+def initWorker(state):
+    worker.clear()
+    worker.update(state)
+
+# A process pool of 'jobs' workers that share 'state'; None for one job
+def pool(jobs,state):
+    if jobs > 1:
+        return(Pool(jobs, initializer=initWorker, initargs=(state,)))
+    return(None)
+
+# 'func' of each of 'items', in the workers of 'pool', or without one here,
+# with 'state' shared as in a worker
+def workerMap(func,items,pool=None,state={}):
+    if pool is None:
+        initWorker(state)
+        return([func(x) for x in items])
+    return(pool.map(func, items, chunksize=1))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps over TEG_model3 scenarios, fanned out over a process pool
+
+    python TEG_sweep.py Bat=23.2e-3,52.5e-3 Vout=2.5,3.3 --out sweep.csv
+    python TEG_sweep.py Bat=23.2e-3,52.5e-3 --cache __resultcache__
+"""
+
+import os
+import csv
+import sys
+import argparse
+import itertools
+import TEG_scenario as scn
+import TEG_cache
+
+def _run(cfg):
+    # one row; a run the model fails on gets an 'error' and no metrics, so
+    # the rest of the sweep carries on
+    traces, cache = scn.worker['traces'], scn.worker['cache']
+    try:
+        if cache is not None:
+            return(dict(cfg, **cache.run(cfg, traces).metrics))
+        return(dict(cfg, **scn.run(cfg, traces)))
+    except scn.failures as e:
+        return(dict(cfg, error='%s: %s' % (type(e).__name__, e)))
+
+# Every combination of the values in 'axes', on top of 'base'
+def grid(base={},**axes):
+    names = list(axes)
+    return([dict(base, **dict(zip(names, values)))
+            for values in itertools.product(*(axes[n] for n in names))])
+
+# Run all configs in 'cfgs'; returns one row of config + metrics per run
+# 'cache' is a TEG_cache.cache, or the name of its folder
+def sweep(cfgs,jobs=None,traces=None,cache=None):
+    if isinstance(cache, str):
+        cache = TEG_cache.cache(cache)
+    if traces is None:  # parse each input file once, for all workers
+        traces = scn.readTraces(*cfgs)
+    state = {'traces': traces, 'cache': cache}
+    pool = scn.pool(jobs or os.cpu_count(), state)
+    try:
+        return(scn.workerMap(_run, cfgs, pool, state))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+# Write sweep rows as a CSV table, to stdout without a file name
+def save(rows,fname=None):
+    cols = []
+    for row in rows:
+        cols += [k for k in row if k not in cols]
+    cols.sort(key=lambda k: k == 'error')  # last, as most rows have none
+    f = open(fname, 'w', newline='') if fname else sys.stdout
+    out = csv.DictWriter(f, cols)
+    out.writeheader()
+    out.writerows(rows)
+    if fname:
+        f.close()
+
+##############################################################################
+# command line: NAME=v1,v2,... axes over the TEG_scenario config keys
+
+def _values(text):
+    return([scn.value(v) for v in text.split(',')])
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Sweep TEG_model3 scenarios')
+    ap.add_argument('axes', nargs='+', metavar='NAME=v1,v2,...')
+    ap.add_argument('--jobs', type=int, default=None,
+                    help='worker processes (default: all cores)')
+    ap.add_argument('--out', default=None, help='CSV file for the table')
+    ap.add_argument('--cache', default=None, metavar='DIR',
+                    help='reuse the results of identical runs from DIR')
+    args = ap.parse_args(argv)
+    axes = {}
+    for ax in args.axes:
+        name, _, text = ax.partition('=')
+        if name not in scn.defaults:
+            ap.error('unknown scenario parameter: %s' % name)
+        axes[name] = _values(text)
+    rows = sweep(grid(**axes), jobs=args.jobs, cache=args.cache)
+    save(rows, args.out)
+    return(rows)
+
+if __name__ == '__main__':
+    main()
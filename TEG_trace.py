@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Compile CSV source traces to the binary form that Psrc memory-maps
+
+    python TEG_trace.py teg_data.csv display_data.csv
+    python TEG_trace.py --check teg_data.csv
+"""
+
+import sys
+import argparse
+import numpy as np
+import Harvest3 as hvst
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Compile CSV traces')
+    ap.add_argument('files', nargs='+', metavar='FILE.csv')
+    ap.add_argument('--out', default=None,
+                    help='output .npy file (one input file only)')
+    ap.add_argument('--check', action='store_true',
+                    help='compare the compiled copy with the CSV')
+    args = ap.parse_args(argv)
+    if args.out and len(args.files) > 1:
+        ap.error('--out takes a single input file')
+    for fname in args.files:
+        npy = hvst.compileTrace(fname, args.out)
+        hdr, time, data = hvst.loadTrace(npy)
+        print('%s -> %s: %d rows, %s/%s, %.6g..%.6g s' % (
+                fname, npy, len(time), hdr['time'], hdr['data'],
+                time[0], time[-1]))
+        if args.check:
+            ref = hvst.readTrace(fname)
+            same = (np.array_equal(ref[1], time) and
+                    np.array_equal(ref[2], data))
+            print('  %s' % ('identical' if same else 'MISMATCH'))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Threshold crossings predicted between ticks, harvester(predict=True)
+
+    python -m pytest -q test_predict.py
+"""
+
+import os
+import Harvest3 as hvst
+import TEG_scenario as scn
+
+here = os.path.dirname(os.path.abspath(__file__))
+files = {'teg_file': os.path.join(here, 'teg_data.csv'),
+         'dsply_file': os.path.join(here, 'display_data.csv')}
+
+def run(cfg,predict):
+    sc = scn.scenario(dict(files, **cfg))
+    sc.harvester.predict = predict
+    return(sc.run(quiet=True))
+
+def tWarm(period,predict):
+    # when Vstor first crosses chgen, as the state log has it
+    sc = run({'clock_period': period, 'stop_time': 0.3}, predict)
+    return(sc.harvester.stateLog.first()[hvst.st['warm']])
+
+# at 10-100x the model's 1 ms period, the cold->warm crossing lands within a
+# quarter period of where a 10 us clock puts it
+def test_crossing_time():
+    ref = tWarm(1e-5, False)
+    for period in (0.01, 0.03, 0.1):
+        assert abs(tWarm(period, True) - ref) < period/4, period
+
+# a crossing into 'full', which adds no input, is left to polling: predicting
+# it must not make the state flip back and forth
+def test_full_not_predicted():
+    logs = [run({'load': 'load'}, predict).harvester.stateLog
+            for predict in (False, True)]
+    assert logs[0].transitions() == logs[1].transitions()